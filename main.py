@@ -1,29 +1,478 @@
 import tkinter as tk
-from tkinter import ttk, scrolledtext, filedialog
-import fitz  # PyMuPDF, for PDF processing
+from tkinter import ttk, scrolledtext
 import re # For table formatting
 import json # For parsing JSON responses
-# Try to import specific fitz error, fall back if not found (e.g. older PyMuPDF)
-try:
-    from fitz.errors import FitzError
-except ImportError:
-    FitzError = Exception # Fallback to generic Exception if specific error not found
+import hashlib
+import io
 import os
 import shutil
-import google.generativeai as genai
-from google.api_core import exceptions as google_exceptions
-# Import specific GenAI exceptions if needed, e.g., genai.types.BlockedPromptException
+import sqlite3
+import itertools
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing
+from functools import lru_cache
+from PIL import Image, ImageOps, UnidentifiedImageError # Pillow for image handling
+from dotenv import load_dotenv # For loading .env files
+from dataclasses import dataclass, field
+# Optional: pyahocorasick speeds up the table-redundancy substring check; fall back to pure Python if missing
 try:
-    from google.generativeai.types import BlockedPromptException, StopCandidateException
+    import ahocorasick
 except ImportError:
-    BlockedPromptException = Exception # Fallback
-    StopCandidateException = Exception # Fallback
+    ahocorasick = None
+# Optional: orjson parses the initial-analysis JSON faster; its JSONDecodeError subclasses json.JSONDecodeError
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# "Label: value" lines of a non-JSON initial-analysis response, mapped to InitialAnalysis fields
+_INITIAL_ANALYSIS_LINE_FIELDS = {
+    "Component1_Type": "component1_type",
+    "Component2_Type": "component2_type",
+    "Functionally_Similar": "functionally_similar",
+    "MFG_PN1": "mfg_pn1",
+    "MFG_PN2": "mfg_pn2",
+}
+# Section header line of a text block: "**Title**" or "## Title" (matched with fullmatch on the stripped line)
+_SECTION_HEADER_RE = re.compile(r"\*\*(.+)\*\*|## (.+)")
+# Markdown pipe-table separator row, e.g. "|---|:--:|" (matched with fullmatch on the stripped line)
+_TABLE_SEPARATOR_RE = re.compile(r"^\s*\|(\s*[:\-]+\s*\|)*\s*[:\-]+\s*\|\s*$")
+# "Key: Value" line of an implicit table; key is group 1, value is group 2 (whitespace around the colon is optional)
+_KEY_VALUE_LINE_RE = re.compile(r"^\s*(.+?)\s*:\s*(.+)\s*$")
+# Leading numbering/bullets on each line of the identified-parameters list
+_PARAMETER_BULLET_RE = re.compile(r"^\s*[\d.\-\s)]+\s*", re.MULTILINE)
+# Single-character cleanup of the identified-parameter list (newlines and full-width commas become commas) before it is re-split on commas
+_PARAMETER_SEPARATOR_TRANSLATION = str.maketrans({'\n': ',', ';': '_', '，': ','})
+# Line breaks (including HTML <br>) replaced by spaces in table cells before they are shown in a Treeview
+_CELL_DISPLAY_BREAK_RE = re.compile(r"\r|\n|<br>")
+# Without pyahocorasick, pattern sets up to this size are matched with one compiled regex alternation
+_SUBSTRING_REGEX_MAX_PATTERNS = 1000
+
+# Threads writing extracted PDF images to disk
+_IMAGE_WRITE_WORKERS = min(8, os.cpu_count() or 1)
+
+# google.generativeai (with protobuf and gRPC) takes most of a second to import, so it is imported where it is used and
+# preloaded on a background thread at startup (see _preload_genai) instead of delaying the first window frame
+
+@lru_cache(maxsize=None)
+def _ai_error_types():
+    """
+    Returns (errors meaning the API key was rejected, errors after which the model and chat session are reset);
+    the AI response handlers check both. Built on first use, after the SDK has been imported.
+    """
+    from google.api_core import exceptions as google_exceptions
+    try:
+        from google.generativeai.types import BlockedPromptException, StopCandidateException
+    except ImportError:
+        BlockedPromptException = Exception # Fallback
+        StopCandidateException = Exception # Fallback
+    return ((google_exceptions.PermissionDenied, google_exceptions.Unauthenticated),
+            (google_exceptions.InvalidArgument, ValueError, BlockedPromptException, StopCandidateException, google_exceptions.NotFound, google_exceptions.PermissionDenied))
+
+def _preload_genai():
+    """Imports google.generativeai on a daemon thread; a later import on the Tk thread then finds it loaded (or waits for it)."""
+    def run():
+        try: import google.generativeai  # Only loads the module
+        except Exception as e: logger.debug("Preloading google.generativeai failed: %s", e) # Reported when it is actually used
+    threading.Thread(target=run, name="genai-preload", daemon=True).start()
+
+def _delete_cached_content(cache):
+    """Deletes a Gemini context cache (run on a daemon thread); if this fails the cache just expires with its TTL."""
+    try: cache.delete()
+    except Exception as e: logger.debug("Could not delete context cache %s: %s", cache.name, e)
+
+def _delete_cached_content_in_background(cache):
+    threading.Thread(target=_delete_cached_content, args=(cache,), name="context-cache-delete", daemon=True).start()
+
+def _write_file_bytes(path: str, data: bytes):
+    """Writes data to path with os-level calls, skipping the file-object and buffer layers of open()."""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o666)
+    try:
+        view = memoryview(data)
+        while view: view = view[os.write(fd, view):] # os.write may write fewer bytes than requested
+    finally:
+        os.close(fd)
+
+def _save_docx_atomically(doc, filepath: str):
+    """Saves a python-docx Document via a temporary file, so an interrupted save never leaves a partial file at filepath."""
+    tmp_path = f"{filepath}.{os.getpid()}_{threading.get_ident()}.tmp"
+    try:
+        doc.save(tmp_path)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        try: os.remove(tmp_path)
+        except OSError: pass
+        raise
+
+def _user_cache_dir() -> str:
+    """Per-user cache folder of the app: under %LOCALAPPDATA% on Windows, $XDG_CACHE_HOME (default ~/.cache) elsewhere."""
+    base = os.environ.get("LOCALAPPDATA") if os.name == "nt" else os.environ.get("XDG_CACHE_HOME")
+    return os.path.join(base or os.path.join(os.path.expanduser("~"), ".cache"), "gemini_spec_compare")
+
+# Extracted PDF text is kept here across runs; outside temp_images, which Clear All deletes
+_PDF_TEXT_CACHE_DIR = os.path.join(_user_cache_dir(), "pdf_text")
+# Least recently used cache files beyond either limit are deleted whenever a new text is stored
+_PDF_TEXT_CACHE_MAX_FILES = 200
+_PDF_TEXT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+def _pdf_file_key(filepath: str) -> str:
+    """Identifies the current content of filepath; the key changes whenever the file is replaced or modified."""
+    st = os.stat(filepath)
+    return hashlib.sha1(f"{os.path.abspath(filepath)}|{st.st_size}|{st.st_mtime_ns}".encode("utf-8")).hexdigest()
+
+def _pdf_text_cache_path(filepath: str) -> str:
+    """Cache file for the text of filepath."""
+    return os.path.join(_PDF_TEXT_CACHE_DIR, f"{_pdf_file_key(filepath)}.txt")
+
+def _store_pdf_text_cache(cache_path: str, text: str):
+    """Writes the cache file via a temporary file so a concurrent reader never sees a partial text."""
+    try:
+        os.makedirs(_PDF_TEXT_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}_{threading.get_ident()}.tmp"
+        _write_file_bytes(tmp_path, text.encode("utf-8"))
+        os.replace(tmp_path, cache_path)
+    except (OSError, UnicodeError) as e: logger.debug("Could not cache PDF text in %s: %s", cache_path, e); return
+    _prune_pdf_text_cache()
+
+def _prune_pdf_text_cache():
+    """Deletes the least recently used cache files beyond _PDF_TEXT_CACHE_MAX_FILES / _PDF_TEXT_CACHE_MAX_BYTES."""
+    try:
+        files = [] # (mtime, size, path)
+        with os.scandir(_PDF_TEXT_CACHE_DIR) as it:
+            for entry in it:
+                if entry.name.endswith(".txt") and entry.is_file():
+                    st = entry.stat(); files.append((st.st_mtime, st.st_size, entry.path))
+    except OSError as e: logger.debug("Could not list the PDF text cache: %s", e); return
+    files.sort(reverse=True) # Newest first; a cache hit touches its file (see extract_text_from_pdf)
+    total_bytes = 0
+    for index, (_, size, path) in enumerate(files):
+        total_bytes += size
+        if index >= _PDF_TEXT_CACHE_MAX_FILES or total_bytes > _PDF_TEXT_CACHE_MAX_BYTES:
+            try: os.remove(path)
+            except OSError as e: logger.debug("Could not delete cached PDF text %s: %s", path, e)
+
+# Answers to send_to_ai requests are kept here across runs (see ResponseCache)
+_RESPONSE_CACHE_PATH = os.path.join(_user_cache_dir(), "ai_responses.sqlite3")
+
+def _prompt_cache_key(model_name: str, parts) -> str:
+    """Digest identifying a generate_content request: the model plus every text part, image blob and image (by its pixels), in order."""
+    digest = hashlib.sha256(model_name.encode("utf-8"))
+    for part in parts:
+        if isinstance(part, dict): # Image blob from _load_prompt_image
+            data = part["data"]
+            header = f"\x00blob:{part['mime_type']}:{len(data)}\x00"
+        elif isinstance(part, Image.Image):
+            data = part.tobytes()
+            header = f"\x00image:{part.mode}:{part.width}x{part.height}:{len(data)}\x00"
+        else:
+            data = str(part).encode("utf-8", "surrogatepass")
+            header = f"\x00text:{len(data)}\x00"
+        digest.update(header.encode("ascii")); digest.update(data)
+    return digest.hexdigest()
+
+# Extracted image formats Gemini accepts as they are; other formats (JPEG 2000, JBIG2, ...) are decoded and re-encoded by the SDK
+_PASSTHROUGH_IMAGE_MIME_TYPES = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".webp": "image/webp"}
+
+# Gemini scales images down to fit this square anyway; larger spec-sheet images are downscaled here instead of uploaded in full
+_SPEC_SHEET_IMAGE_MAX_SIDE = 3072
+
+# Decoded spec-sheet images are kept up to this many pixels in total (~200 MB as RGB), least recently used dropped first
+_PROMPT_IMAGE_CACHE_MAX_PIXELS = 64 * 1024 * 1024
+
+class _DecodedImageCache:
+    """Thread-safe LRU of decoded images keyed by (path, size, mtime), bounded by their total pixel count."""
+    __slots__ = ("_max_pixels", "_images", "_pixels", "_lock")
+
+    def __init__(self, max_pixels: int):
+        self._max_pixels = max_pixels
+        self._images: OrderedDict[tuple, Image.Image] = OrderedDict()
+        self._pixels = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> Image.Image | None:
+        with self._lock:
+            img = self._images.get(key)
+            if img is not None: self._images.move_to_end(key)
+            return img
+
+    def put(self, key: tuple, img: Image.Image):
+        with self._lock:
+            old = self._images.pop(key, None)
+            if old is not None: self._pixels -= old.width * old.height
+            self._images[key] = img; self._pixels += img.width * img.height
+            while self._pixels > self._max_pixels and len(self._images) > 1:
+                _, evicted = self._images.popitem(last=False); self._pixels -= evicted.width * evicted.height
+
+    def clear(self):
+        with self._lock: self._images.clear(); self._pixels = 0
+
+_decoded_prompt_images = _DecodedImageCache(_PROMPT_IMAGE_CACHE_MAX_PIXELS)
+
+def _decode_prompt_image(path: str) -> Image.Image:
+    """Decodes a spec-sheet image file for a prompt, downscaled to _SPEC_SHEET_IMAGE_MAX_SIDE; unchanged files are decoded once."""
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime_ns) # Checked before the file is read
+    img = _decoded_prompt_images.get(key)
+    if img is not None: return img
+    with Image.open(path) as src:
+        if max(src.size) > _SPEC_SHEET_IMAGE_MAX_SIDE: src.thumbnail((_SPEC_SHEET_IMAGE_MAX_SIDE, _SPEC_SHEET_IMAGE_MAX_SIDE), Image.Resampling.LANCZOS)
+        # Upright plain-Image copy, decoded here on the extraction thread: the SDK uploads a file-backed image's original
+        # file, which would undo the downscale and skip the re-encoding of formats Gemini does not accept
+        img = ImageOps.exif_transpose(src)
+    _decoded_prompt_images.put(key, img)
+    return img
+
+def _load_prompt_image(path: str) -> dict | Image.Image:
+    """
+    Returns the prompt part for an extracted spec-sheet image: a {"mime_type", "data"} blob of the file's bytes when
+    Gemini accepts the format and the image fits _SPEC_SHEET_IMAGE_MAX_SIDE (nothing is decoded, and the SDK has nothing
+    to re-encode), otherwise the decoded, downscaled image.
+    """
+    mime_type = _PASSTHROUGH_IMAGE_MIME_TYPES.get(os.path.splitext(path)[1].lower())
+    if mime_type is not None:
+        with Image.open(path) as probe: fits = max(probe.size) <= _SPEC_SHEET_IMAGE_MAX_SIDE # Header only; also rejects unreadable files
+        if fits:
+            with open(path, "rb") as f: return {"mime_type": mime_type, "data": f.read()}
+    return _decode_prompt_image(path)
+
+# Attached chat images are downscaled to fit this square before sending; larger images only cost upload time and tokens
+_USER_IMAGE_MAX_SIDE = 1024
+
+def _open_user_image(path: str) -> Image.Image:
+    """Opens and decodes an image the user attached to a chat message, downscaled to _USER_IMAGE_MAX_SIDE."""
+    img = Image.open(path)
+    if max(img.size) > _USER_IMAGE_MAX_SIDE:
+        img.thumbnail((_USER_IMAGE_MAX_SIDE, _USER_IMAGE_MAX_SIDE), Image.Resampling.LANCZOS) # JPEGs decode at reduced scale (draft mode)
+        # Upright plain-Image copy: the SDK uploads a file-backed image's original file, which would undo the downscale
+        return ImageOps.exif_transpose(img)
+    img.load() # Decode now so Pillow releases the file handle
+    return img
+
+# Models offered in the model combobox
+_MODEL_OPTIONS = ("models/gemini-1.0-pro-vision-latest", "models/gemini-pro-vision","models/gemini-1.5-flash-latest", "models/gemini-1.5-flash","models/gemini-1.5-flash-002", "models/gemini-1.5-flash-8b","models/gemini-1.5-flash-8b-001", "models/gemini-1.5-flash-8b-latest","models/gemini-2.5-flash-preview-04-17", "models/gemini-2.5-flash-preview-05-20","models/gemini-2.5-flash-preview-04-17-thinking", "models/gemini-2.0-flash-exp","models/gemini-2.0-flash", "models/gemini-2.0-flash-001","models/gemini-2.0-flash-exp-image-generation", "models/gemini-2.0-flash-lite-001","models/gemini-2.0-flash-lite", "models/gemini-2.0-flash-lite-preview-02-05","models/gemini-2.0-flash-lite-preview", "models/gemini-2.0-flash-thinking-exp-01-21","models/gemini-2.0-flash-thinking-exp", "models/gemini-2.0-flash-thinking-exp-1219","models/learnlm-2.0-flash-experimental", "models/gemma-3-1b-it","models/gemma-3-4b-it", "models/gemma-3-12b-it","models/gemma-3-27b-it", "models/gemma-3n-e4b-it")
+_MODEL_OPTION_NAMES = frozenset(_MODEL_OPTIONS) # For the model-name check in _initialize_model
+
+# Component names longer than this are cut (with "...") in the comparison table headings
+_HEADING_MAX_CHARS = 25
+
+def _shorten_heading(text: str) -> str:
+    """Returns text cut to _HEADING_MAX_CHARS characters, with "..." appended when it was longer."""
+    return text if len(text) <= _HEADING_MAX_CHARS else text[:_HEADING_MAX_CHARS] + "..."
+
+def _is_positive_similarity(text) -> bool:
+    """True if a "Functionally_Similar" answer (JSON value or text) starts with "yes" (any letter case) or "是"."""
+    return isinstance(text, str) and (text[:3].lower() == "yes" or text.startswith("是")) # Lowercases 3 chars, not the whole answer
+
+@dataclass(slots=True)
+class InitialAnalysis:
+    """Structured result of the initial component analysis."""
+    component1_type: str = "Unknown"
+    component2_type: str = "Unknown"
+    functionally_similar: str = "Unknown"
+    is_similar_flag: bool = False
+    mfg_pn1: str = "Not Found"
+    mfg_pn2: str = "Not Found"
+
+class ResponseCache:
+    """
+    Persistent LRU of AI response texts in SQLite, keyed by _prompt_cache_key; entries expire ttl_seconds after being stored.
+    Every call opens its own connection, so any worker thread may use it; database errors are logged and act as misses.
+    """
+    __slots__ = ("_path", "_max_entries", "_ttl_seconds")
 
-from PIL import Image, ImageTk, UnidentifiedImageError # Pillow for image handling
-import docx # For downloading history
-from docx.shared import RGBColor # For coloring text in Word
-from dotenv import load_dotenv # For loading .env files
-import traceback # For detailed error logging
+    def __init__(self, path: str, max_entries: int, ttl_seconds: float):
+        self._path = path
+        self._max_entries = max_entries
+        self._ttl_seconds = ttl_seconds
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        conn = sqlite3.connect(self._path, timeout=5)
+        conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, stored REAL NOT NULL, used REAL NOT NULL)")
+        return conn
+
+    def get(self, key: str) -> str | None:
+        try:
+            with closing(self._connect()) as conn, conn:
+                now = time.time()
+                row = conn.execute("SELECT response FROM responses WHERE key = ? AND stored > ?", (key, now - self._ttl_seconds)).fetchone()
+                if row is None: return None
+                conn.execute("UPDATE responses SET used = ? WHERE key = ?", (now, key))
+                return row[0]
+        except (sqlite3.Error, OSError) as e: logger.debug("Response cache lookup failed: %s", e); return None
+
+    def put(self, key: str, response_text: str):
+        try:
+            with closing(self._connect()) as conn, conn:
+                now = time.time()
+                conn.execute("INSERT OR REPLACE INTO responses (key, response, stored, used) VALUES (?, ?, ?, ?)", (key, response_text, now, now))
+                conn.execute("DELETE FROM responses WHERE stored <= ?", (now - self._ttl_seconds,))
+                conn.execute("DELETE FROM responses WHERE key NOT IN (SELECT key FROM responses ORDER BY used DESC LIMIT ?)", (self._max_entries,))
+        except (sqlite3.Error, OSError) as e: logger.debug("Response cache store failed: %s", e)
+
+class SubstringMatcher:
+    """
+    Tests whether a line contains any of a fixed set of strings, or is contained in one of them.
+    Uses an Aho-Corasick automaton when pyahocorasick is available, so each query is a single
+    scan of the line regardless of how many strings are in the set; otherwise a regex alternation
+    of the strings does the scan in C.
+    """
+    __slots__ = ("_patterns", "_joined", "_automaton", "_regex")
+
+    def __init__(self, patterns):
+        self._patterns = [p for p in patterns if p]
+        # Patterns joined by a separator that never occurs in a line: "line in some pattern" is one C-level scan
+        self._joined = "\x00".join(self._patterns)
+        self._automaton = None
+        if ahocorasick is not None and self._patterns:
+            automaton = ahocorasick.Automaton()
+            for pattern in self._patterns:
+                automaton.add_word(pattern, pattern)
+            automaton.make_automaton()
+            self._automaton = automaton
+        self._regex = None
+        if self._automaton is None and 0 < len(self._patterns) <= _SUBSTRING_REGEX_MAX_PATTERNS:
+            self._regex = re.compile("|".join(map(re.escape, self._patterns)))
+
+    def matches(self, line: str) -> bool:
+        if not self._patterns or not line:
+            return False
+        if line in self._joined:
+            return True
+        if self._automaton is not None:
+            return next(self._automaton.iter(line), None) is not None
+        if self._regex is not None:
+            return self._regex.search(line) is not None
+        return any(pattern in line for pattern in self._patterns)
+
+@dataclass(slots=True)
+class TableNormalization:
+    """Normalized (stripped, lower-cased) lookups of a ParsedTable, used by the redundancy check."""
+    headers: frozenset[str]     # every normalized header
+    cells: frozenset[str]       # every normalized cell
+    column_index: dict[str, int] # normalized header -> index of its first column
+    row_index: dict[str, int]   # normalized first cell -> index of its first row
+    cell_matcher: SubstringMatcher # substring matcher over all normalized cells
+    # ("column" | "row", index) -> non-empty normalized cells of that column/row and their matcher, filled on demand
+    focused_cells: dict[tuple[str, int], tuple[frozenset[str], SubstringMatcher]] = field(default_factory=dict)
+
+@dataclass(slots=True)
+class ParsedTable:
+    """A table segment parsed from an AI response (pipe table or implicit 'Key: Value' table)."""
+    headers: list[str]
+    rows: list[list[str]] = field(default_factory=list)
+    # Computed on first redundancy check and reused for every later text block checked against this table
+    _normalized: TableNormalization | None = field(default=None, init=False, repr=False, compare=False)
+
+@dataclass(slots=True)
+class TextSegment:
+    """A plain text segment of an AI response."""
+    content: str
+
+class AIResponseSegmenter:
+    """
+    Splits an AI response into TextSegment/ParsedTable segments in one pass over its lines.
+    Text may be fed incrementally (e.g. the chunks of a streamed response): feed() returns the
+    segments completed so far and close() flushes the rest.
+    finalize_text_block(lines, last_table) turns a buffered text block into a segment or None.
+    """
+    _TEXT, _TABLE_HEADER, _TABLE_BODY = range(3)
+
+    def __init__(self, finalize_text_block):
+        self._finalize_text_block = finalize_text_block
+        self._partial_line = "" # Unterminated tail of the last chunk
+        self._state = self._TEXT
+        self._text_block = [] # Lines of the text block being collected
+        self._header_lines = [] # Candidate table header line plus blank lines seen after it
+        self._table = None # Table whose rows are being collected
+        self._last_table = None # Most recent table, for redundancy checks of the text after it
+        self._completed = []
+
+    def feed(self, chunk: str) -> list[ParsedTable | TextSegment]:
+        lines = (self._partial_line + chunk).splitlines(keepends=True)
+        self._partial_line = ""
+        # Hold back an unterminated last line, or one ending in '\r' whose '\n' may be in the next chunk
+        if lines and (lines[-1].endswith('\r') or lines[-1].splitlines()[0] == lines[-1]):
+            self._partial_line = lines.pop()
+        for line in lines:
+            self._process_line(line.splitlines()[0])
+        return self._take_completed()
+
+    def close(self) -> list[ParsedTable | TextSegment]:
+        for line in self._partial_line.splitlines():
+            self._process_line(line)
+        self._partial_line = ""
+        if self._state == self._TABLE_HEADER:
+            self._abandon_table_header()
+        if self._state == self._TABLE_BODY:
+            self._end_table()
+        self._flush_text_block()
+        return self._take_completed()
+
+    def _process_line(self, line: str):
+        stripped = line.strip()
+        if self._state == self._TABLE_BODY:
+            if not stripped:
+                return # Blank lines within or right after a table are skipped
+            if stripped.startswith('|') and stripped.endswith('|') and stripped.count('|') == len(self._table.headers) + 1:
+                self._table.rows.append([cell.strip() for cell in stripped[1:-1].split('|')])
+                return
+            self._end_table() # This line is handled as text (or a new table) below
+        elif self._state == self._TABLE_HEADER:
+            if not stripped:
+                self._header_lines.append(line)
+                return
+            header = self._header_lines[0].strip()
+            if _TABLE_SEPARATOR_RE.fullmatch(stripped) and stripped.count('|') == header.count('|'):
+                self._flush_text_block() # The text before the table is complete
+                self._table = ParsedTable([h.strip() for h in header[1:-1].split('|')])
+                self._header_lines = []
+                self._state = self._TABLE_BODY
+                return
+            self._abandon_table_header() # Not a table; this line is handled below
+
+        if stripped.startswith('|') and stripped.endswith('|') and stripped.count('|') >= 2:
+            self._header_lines = [line] # Possible table header; decided by the next non-blank line
+            self._state = self._TABLE_HEADER
+        elif not stripped: # A blank line ends the current text block
+            self._flush_text_block()
+        else:
+            self._text_block.append(line)
+
+    def _abandon_table_header(self):
+        """The candidate header was not followed by a separator: replay it as ordinary text."""
+        header_line, *blank_lines = self._header_lines
+        self._header_lines = []
+        self._state = self._TEXT
+        self._text_block.append(header_line)
+        for line in blank_lines:
+            self._process_line(line)
+
+    def _end_table(self):
+        self._completed.append(self._table)
+        self._last_table = self._table
+        self._table = None
+        self._state = self._TEXT
+
+    def _flush_text_block(self):
+        if self._text_block:
+            segment = self._finalize_text_block(self._text_block, self._last_table)
+            if segment:
+                self._completed.append(segment)
+                if isinstance(segment, ParsedTable): # An implicit table
+                    self._last_table = segment
+            self._text_block = []
+
+    def _take_completed(self):
+        completed, self._completed = self._completed, []
+        return completed
 
 class Tooltip:
     """
@@ -33,35 +482,43 @@ class Tooltip:
         self.widget = widget
         self.text_callback = text_callback
         self.tip_window = None
+        self.tip_label = None
+        self.tip_visible = False
         self.widget.bind("<Enter>", self.show_tip)
         self.widget.bind("<Leave>", self.hide_tip)
 
     def show_tip(self, event=None):
         """Display tooltip"""
-        if self.tip_window or not hasattr(self, 'text_callback'):
+        if self.tip_visible or not hasattr(self, 'text_callback'):
             return
 
         text = self.text_callback()
         if not text:
             return
 
+        # The widget can move with its window, so the position is read on every hover
         x = self.widget.winfo_rootx() + 20
         y = self.widget.winfo_rooty() + self.widget.winfo_height() + 1
 
-        self.tip_window = tw = tk.Toplevel(self.widget)
-        tw.wm_overrideredirect(True)
-        tw.wm_geometry(f"+{x}+{y}")
+        if self.tip_window is None: # Built on the first hover, then withdrawn and re-shown instead of recreated
+            self.tip_window = tw = tk.Toplevel(self.widget)
+            tw.wm_withdraw()
+            tw.wm_overrideredirect(True)
+            self.tip_label = tk.Label(tw, justify=tk.LEFT,
+                                      background="#ffffe0", relief=tk.SOLID, borderwidth=1,
+                                      font=("tahoma", "8", "normal"))
+            self.tip_label.pack(ipadx=1)
 
-        label = tk.Label(tw, text=text, justify=tk.LEFT,
-                         background="#ffffe0", relief=tk.SOLID, borderwidth=1,
-                         font=("tahoma", "8", "normal"))
-        label.pack(ipadx=1)
+        self.tip_label.config(text=text)
+        self.tip_window.wm_geometry(f"+{x}+{y}")
+        self.tip_window.wm_deiconify()
+        self.tip_visible = True
 
     def hide_tip(self, event=None):
         """Hide tooltip"""
-        if self.tip_window:
-            self.tip_window.destroy()
-        self.tip_window = None
+        if self.tip_visible:
+            self.tip_window.wm_withdraw()
+        self.tip_visible = False
 
 class ComponentComparatorAI:
     """
@@ -69,6 +526,78 @@ class ComponentComparatorAI:
     Manages the UI, file loading, PDF processing, AI interaction,
     and conversation history.
     """
+    # Section labels of the fused parameters + detailed comparison response
+    DETAILED_PARAMETERS_LABEL = "PARAMETERS:"
+    DETAILED_TABLE_LABEL = "TABLE:"
+    # The TABLE label at a line start in any letter case, with markdown decoration around it (e.g. "**Table:**")
+    DETAILED_TABLE_LABEL_RE = re.compile(rf"^[^\w\n]*{re.escape(DETAILED_TABLE_LABEL)}[*_]*", re.IGNORECASE | re.MULTILINE)
+    # Number of comparison Treeview rows inserted per Tk idle callback
+    TREEVIEW_INSERT_CHUNK_SIZE = 20
+    # How often the history display checks whether a queued AI message has finished formatting
+    DISPLAY_POLL_INTERVAL_MS = 30
+    AI_CONFIGURED_MESSAGE = "Generative AI configured successfully."
+    # Leads every chat prompt sent by send_user_query
+    CHAT_SOURCING_INSTRUCTION = (
+        "IMPORTANT INSTRUCTIONS FOR AI RESPONSE:\n"
+        "- Base your answers primarily on the information extracted from the provided component datasheets "
+        "(text, images, and context from previous conversation turns, including component type and MFG P/N if known).\n"
+        "- If the datasheets or prior conversation context lack specific information to answer your query, you may use your general knowledge.\n"
+        "- If you use general knowledge, you MUST explicitly state that the information was not found in the provided datasheets/context "
+        "and that your answer is based on general understanding.\n\n"
+    )
+    # Sourcing rules of the detailed-comparison request (the chat variant is CHAT_SOURCING_INSTRUCTION)
+    DATASHEET_SOURCING_INSTRUCTION = (
+        "IMPORTANT INSTRUCTIONS FOR AI RESPONSE:\n"
+        "- Base your answers primarily on the information extracted from the provided component datasheets "
+        "(text, images, and context from previous turns).\n"
+        "- If the datasheets lack specific information to answer a point, you may use your general knowledge.\n"
+        "- If you use general knowledge, you MUST explicitly state for which points the information was not found "
+        "in the datasheets and that your answer for those points is based on general understanding.\n"
+    )
+    # Instructions and output format of the initial analysis request (parsed by _parse_initial_analysis_response)
+    INITIAL_ANALYSIS_INSTRUCTIONS = (
+        "You are an expert electronics component analyst. Analyze the two component specification sheets above "
+        "(Component 1 is the first datasheet, Component 2 the second).\n\n"
+        "**Instructions for AI:**\n"
+        "1. For Component 1 (described first), identify its specific component type.\n"
+        "2. For Component 2 (described second), identify its specific component type.\n"
+        "3. Assess if Component 1 and Component 2 are functionally similar (e.g., both are dual N-channel MOSFETs, or one is an LDO regulator and the other a switching regulator, or one is a TVS diode and the other a Zener diode). Your assessment should be based on their primary function.\n"
+        "4. For Component 1, find and extract the first complete Manufacturer Part Number (MFG P/N) listed in its 'Order Information' or equivalent section. If multiple are listed, provide only the first one. If none is explicitly found, state 'Not Found'.\n"
+        "5. For Component 2, find and extract the first complete Manufacturer Part Number (MFG P/N) listed in its 'Order Information' or equivalent section. If multiple are listed, provide only the first one. If none is explicitly found, state 'Not Found'.\n\n"
+        "**Output Format:**\n"
+        "Please provide your response *only* in the following structured format, using these exact labels:\n"
+        "Component1_Type: [Type for component 1]\n"
+        "Component2_Type: [Type for component 2]\n"
+        "Functionally_Similar: [Yes/No, brief explanation]\n"
+        "MFG_PN1: [MFG P/N for component 1 or 'Not Found']\n"
+        "MFG_PN2: [MFG P/N for component 2 or 'Not Found']\n"
+    )
+    # Request-specific parts of the detailed comparison that follow the P/N line (the labels are resolved once, here)
+    DETAILED_COMPARISON_TASKS = (
+        DATASHEET_SOURCING_INSTRUCTION,
+        "Based PRIMARILY on the provided datasheet texts above, please perform the following:",
+        "1. Identify the crucial electrical and physical parameters relevant for comparing these specific component types. "
+        "Focus on parameters typically found in datasheets that are essential for electrical engineers to make a selection.",
+        "2. List all key specification differences (especially considering the parameters identified in point 1) in a clear, concise markdown table format. Ensure the table includes columns for Parameter, Value for Component 1, and Value for Component 2. Include a 'Notes' or 'Difference' column if applicable.",
+        "3. Explicitly state their full Operating Temperature ranges (e.g., -40°C to 125°C).",
+        "4. Assess SMT Compatibility: Can Component 2's package (based on its description in provided text/images - though prioritize the full texts now re-provided) likely be SMT'd onto Component 1's typical PCB footprint? Consider common package names and pin counts. State any assumptions clearly.",
+        "5. Package size including leads for two parts",
+        "**Response Format:**\n"
+        f"Start your response with a single line '{DETAILED_PARAMETERS_LABEL} ' followed by only the parameter names from point 1, separated by commas.\n"
+        f"Then write a line containing only '{DETAILED_TABLE_LABEL}' followed by the markdown table from point 2 and your answers to points 3 to 5."
+    )
+    RESPONSE_IN_CHINESE_INSTRUCTION = " Please provide your entire response in Chinese."
+    RESPONSE_IN_ENGLISH_INSTRUCTION = " Please provide your entire response in English."
+    # Oldest conversation_log entries are dropped beyond this, bounding memory and the history export
+    CONVERSATION_LOG_MAX_ENTRIES = 5000
+    # The oldest lines of the history widget are deleted beyond this, so long sessions keep inserts and redraws cheap
+    HISTORY_DISPLAY_MAX_LINES = 20000
+    # Lifetime of the explicit Gemini context cache that holds the datasheet block
+    DATASHEET_CACHE_TTL_SECONDS = 30 * 60
+    # Least recently used answers beyond this are dropped from the persistent response cache
+    RESPONSE_CACHE_MAX_ENTRIES = 1000
+    RESPONSE_CACHE_TTL_SECONDS = 24 * 3600 # Stored answers are reused for a day at most
+
     def __init__(self, root):
         """
         Initializes the application UI and internal state.
@@ -80,21 +609,49 @@ class ComponentComparatorAI:
         load_dotenv()
 
         self.spec_sheet_1_path = None; self.spec_sheet_1_text = None; self.spec_sheet_1_image_paths = []
-        self.mfg_pn_var_1 = tk.StringVar()
+        self.mfg_pn_var_1 = tk.StringVar(root)
         self.spec_sheet_2_path = None; self.spec_sheet_2_text = None; self.spec_sheet_2_image_paths = []
-        self.mfg_pn_var_2 = tk.StringVar()
+        self.mfg_pn_var_2 = tk.StringVar(root)
 
-        self.model = None; self.chat_session = None; self.conversation_log = []; self.ai_history = []
+        # Segments depend only on the message text, so the display and the .docx export share one memo of the parse
+        self._format_ai_response_cached = lru_cache(maxsize=self.CONVERSATION_LOG_MAX_ENTRIES)(self._format_ai_response)
+        self._background_generation = 0 # Bumped when the conversation is reset; results of older tasks are dropped
+        self.model = None; self.chat_session = None; self._reset_conversation_log()
         self.api_key_configured = False; self.model_options_list = []
+        self._api_key = None # GOOGLE_API_KEY as last read by _configure_ai
+        self._configured_api_key = None # Key genai.configure was last called with; configuring again discards the SDK's connected clients
         self.placeholder_text = "Select AI Model (after loading files)"; self.model_initializing = False
         self.start_comparison_button = None
         self.upload_image_button = None
-        self.pending_user_image_path = None
-        self.pending_user_image_pil = None
-        self.translate_to_chinese_var = tk.BooleanVar(value=False)
+        self.pending_user_image_path = None # Attached image, decoded only when the message is sent
+        self._pending_treeview_rows = None # Row iterator of the comparison table being inserted
+        # AI responses are formatted on a worker thread; history entries are rendered in order from this queue
+        self._format_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ai-format")
+        self._display_queue = deque() # (content or Future of segments, tag, raw message)
+        self._display_poll_id = None
+        # Frame/Treeview widgets embedded for history tables, as [frame, tree, column_ids]; recycled when the history is cleared
+        self._history_tables_in_use = []
+        self._history_table_pool = []
+        # Streamed chat chunks not yet shown, and whether the "stream_preview" text has been started (see _show_streamed_chunk)
+        self._stream_preview_pending = []
+        self._stream_preview_started = False
+        # Background tasks (PDF extraction, generate_content, chat messages) post (generation, callback, args, is_final) here;
+        # the Tk thread runs the callbacks from _poll_background_results
+        self._background_results = queue.SimpleQueue()
+        self._background_task_running = False
+        self._background_poll_id = None
+        self._worker_context = threading.local() # .generation is set on background task threads
+        # (key, CachedContent, cached model, expiry) for the datasheet block; CachedContent is None if the model can't cache it
+        self._datasheet_cache = None
+        self._datasheet_cache_lock = threading.Lock() # _datasheet_cache is replaced by workers and discarded by clear_all
+        self._response_cache = ResponseCache(_RESPONSE_CACHE_PATH, self.RESPONSE_CACHE_MAX_ENTRIES, self.RESPONSE_CACHE_TTL_SECONDS) # Used from background tasks only
+        self._image_dir_counter = itertools.count() # Unique suffix for each extracted-image folder
+        self._extracted_image_paths = {} # _pdf_file_key -> image files extracted into temp_image_dir, reused while they exist
+        self.translate_to_chinese_var = tk.BooleanVar(root, value=False)
 
 
         self.temp_image_dir = "temp_images"; self._create_temp_image_dir()
+        _preload_genai()
         self._setup_ui(root); self._configure_ai()
 
         self.update_conversation_history(
@@ -107,7 +664,7 @@ class ComponentComparatorAI:
     def _create_temp_image_dir(self):
         if not os.path.exists(self.temp_image_dir):
             try: os.makedirs(self.temp_image_dir)
-            except OSError as e: print(f"Critical Error creating temp dir {self.temp_image_dir}: {e}"); self.update_conversation_history(f"System: Error creating temp folder: {e}", role="error")
+            except OSError as e: logger.error("Critical error creating temp dir %s: %s", self.temp_image_dir, e); self.update_conversation_history(f"System: Error creating temp folder: {e}", role="error")
 
     def _setup_ui(self, root):
         current_row = 0
@@ -140,9 +697,9 @@ class ComponentComparatorAI:
 
         # Model Selection
         ttk.Label(root, text="Select AI Model:").grid(row=current_row, column=0, padx=10, pady=5, sticky="w")
-        self.model_var = tk.StringVar()
+        self.model_var = tk.StringVar(root)
         self.model_combobox = ttk.Combobox(root, textvariable=self.model_var, width=50)
-        self.model_options_list = ["models/gemini-1.0-pro-vision-latest", "models/gemini-pro-vision","models/gemini-1.5-flash-latest", "models/gemini-1.5-flash","models/gemini-1.5-flash-002", "models/gemini-1.5-flash-8b","models/gemini-1.5-flash-8b-001", "models/gemini-1.5-flash-8b-latest","models/gemini-2.5-flash-preview-04-17", "models/gemini-2.5-flash-preview-05-20","models/gemini-2.5-flash-preview-04-17-thinking", "models/gemini-2.0-flash-exp","models/gemini-2.0-flash", "models/gemini-2.0-flash-001","models/gemini-2.0-flash-exp-image-generation", "models/gemini-2.0-flash-lite-001","models/gemini-2.0-flash-lite", "models/gemini-2.0-flash-lite-preview-02-05","models/gemini-2.0-flash-lite-preview", "models/gemini-2.0-flash-thinking-exp-01-21","models/gemini-2.0-flash-thinking-exp", "models/gemini-2.0-flash-thinking-exp-1219","models/learnlm-2.0-flash-experimental", "models/gemma-3-1b-it","models/gemma-3-4b-it", "models/gemma-3-12b-it","models/gemma-3-27b-it", "models/gemma-3n-e4b-it"]
+        self.model_options_list = _MODEL_OPTIONS
         self.model_combobox['values'] = self.model_options_list
         self.model_combobox.set(self.placeholder_text); self.model_combobox.state(["disabled"])
         self.model_combobox.grid(row=current_row, column=1, padx=5, pady=5, sticky="ew")
@@ -245,84 +802,65 @@ class ComponentComparatorAI:
         current_text = self.mfg_pn_entry_2.get()
         self.mfg_pn_var_2.set(current_text)
 
-    def _parse_initial_analysis_response(self, response_text: str) -> dict:
+    def _parse_initial_analysis_response(self, response_text: str) -> InitialAnalysis:
         """Parses the structured AI response from the initial analysis."""
-        data = {
-            "component1_type": "Unknown",
-            "component2_type": "Unknown",
-            "functionally_similar": "Unknown",
-            "is_similar_flag": False,  # Default to False
-            "mfg_pn1": "Not Found",
-            "mfg_pn2": "Not Found"
-        }
+        data = InitialAnalysis()
         try:
             # Attempt to parse as JSON first
             # Remove potential markdown backticks from JSON string
-            cleaned_response_text = response_text.strip()
-            if cleaned_response_text.startswith("```json"):
-                cleaned_response_text = cleaned_response_text[7:]
-            if cleaned_response_text.startswith("```"):
-                cleaned_response_text = cleaned_response_text[3:]
-            if cleaned_response_text.endswith("```"):
-                cleaned_response_text = cleaned_response_text[:-3]
-
-            parsed_json = json.loads(cleaned_response_text.strip())
-            data["component1_type"] = parsed_json.get("Component1_Type", "Unknown")
-            data["component2_type"] = parsed_json.get("Component2_Type", "Unknown")
+            cleaned_response_text = response_text.strip().removeprefix("```json").removeprefix("```").removesuffix("```").strip()
+            parsed_json = orjson.loads(cleaned_response_text) if orjson else json.loads(cleaned_response_text)
+            data.component1_type = parsed_json.get("Component1_Type", "Unknown")
+            data.component2_type = parsed_json.get("Component2_Type", "Unknown")
             similarity_text = parsed_json.get("Functionally_Similar", "Unknown")
-            data["functionally_similar"] = similarity_text
-            if isinstance(similarity_text, str) and (similarity_text.lower().startswith("yes") or similarity_text.startswith("是")):
-                data["is_similar_flag"] = True
-            data["mfg_pn1"] = parsed_json.get("MFG_PN1", "Not Found")
-            data["mfg_pn2"] = parsed_json.get("MFG_PN2", "Not Found")
+            data.functionally_similar = similarity_text
+            if _is_positive_similarity(similarity_text):
+                data.is_similar_flag = True
+            data.mfg_pn1 = parsed_json.get("MFG_PN1", "Not Found")
+            data.mfg_pn2 = parsed_json.get("MFG_PN2", "Not Found")
 
             # Ensure "Not Found" from JSON still results in empty string for P/N variables if needed by downstream logic
             # (Current downstream logic in send_to_ai seems to handle "Not Found" correctly by setting P/N var to "" or the value)
 
         except json.JSONDecodeError:
             # Fallback to original line-by-line parsing if JSON parsing fails
-            lines = response_text.split('\n')
-            for line in lines:
-                if line.startswith("Component1_Type:"):
-                    data["component1_type"] = line.split(":", 1)[1].strip()
-                elif line.startswith("Component2_Type:"):
-                    data["component2_type"] = line.split(":", 1)[1].strip()
-                elif line.startswith("Functionally_Similar:"):
-                    similarity_text = line.split(":", 1)[1].strip()
-                    data["functionally_similar"] = similarity_text
-                    if similarity_text.lower().startswith("yes") or similarity_text.startswith("是"):
-                        data["is_similar_flag"] = True
-                elif line.startswith("MFG_PN1:"):
-                    data["mfg_pn1"] = line.split(":", 1)[1].strip()
-                elif line.startswith("MFG_PN2:"):
-                    data["mfg_pn2"] = line.split(":", 1)[1].strip()
+            for line in response_text.split('\n'):
+                label, separator, value = line.partition(":")
+                field_name = _INITIAL_ANALYSIS_LINE_FIELDS.get(label) if separator else None
+                if field_name is None:
+                    continue
+                value = value.strip()
+                setattr(data, field_name, value)
+                if field_name == "functionally_similar" and _is_positive_similarity(value):
+                    data.is_similar_flag = True
         return data
 
     def on_upload_image(self):
+        from tkinter import filedialog  # File dialogs are imported on first use to keep them off the startup path
         filetypes = [('Image files', '*.png *.jpg *.jpeg *.bmp *.gif *.webp'), ('All files', '*.*')]
         filepath = filedialog.askopenfilename(title="Select an Image for AI Analysis", filetypes=filetypes)
         if filepath:
             try:
-                img = Image.open(filepath)
+                with Image.open(filepath) as img: img.verify() # Validate without keeping decoded pixels around until send
                 self.pending_user_image_path = filepath
-                self.pending_user_image_pil = img
                 image_name = os.path.basename(filepath)
                 self.update_conversation_history(f"System: Image '{image_name}' attached. It will be sent with your next message.", role="system")
             except FileNotFoundError:
                 self.update_conversation_history(f"System: Error - Image file not found at {filepath}", role="error")
-                self.pending_user_image_path = None; self.pending_user_image_pil = None
+                self.pending_user_image_path = None
             except UnidentifiedImageError:
                 self.update_conversation_history(f"System: Error - Cannot identify image file. Not a valid image format? File: {filepath}", role="error")
-                self.pending_user_image_path = None; self.pending_user_image_pil = None
+                self.pending_user_image_path = None
             except Exception as e:
                 self.update_conversation_history(f"System: Error processing image {filepath}: {e}", role="error")
-                self.pending_user_image_path = None; self.pending_user_image_pil = None
+                self.pending_user_image_path = None
 
     def on_start_detailed_comparison(self):
         self.update_conversation_history("System: 'Start Detailed Comparison' initiated...", role="system")
-        if hasattr(self, 'start_comparison_button'):
+        if self.start_comparison_button is not None:
             self.start_comparison_button.config(state=tk.DISABLED)
 
+        request_sent = False # Once sent, _on_detailed_comparison_response re-enables the button
         try:
             if not self.model:
                 self.update_conversation_history("System: No AI model initialized. Please select a model.", role="error")
@@ -331,199 +869,155 @@ class ComponentComparatorAI:
                 self.update_conversation_history("System: Both spec sheets must be loaded and processed.", role="error")
                 return
 
-            if hasattr(self, 'root'): self.root.update_idletasks()
             mfg_pn1 = self.mfg_pn_var_1.get() if hasattr(self, 'mfg_pn_var_1') and self.mfg_pn_var_1.get() else "N/A"
             mfg_pn2 = self.mfg_pn_var_2.get() if hasattr(self, 'mfg_pn_var_2') and self.mfg_pn_var_2.get() else "N/A"
 
-            # Stage 1: Fetch Parameters
-            self.update_conversation_history(f"System: Stage 1: Fetching relevant parameters for {mfg_pn1} vs {mfg_pn2}...", role="system")
-
-            stage1_prompt_text = (
-                f"Based on the two electronic components identified by MFG P/N 1: {mfg_pn1} and MFG P/N 2: {mfg_pn2}, "
-                "please list the crucial electrical and physical parameters relevant for comparing these specific component types. "
-                "Focus on parameters typically found in datasheets that are essential for electrical engineers to make a selection. "
-                "Only list the parameter names, separated by commas."
-            )
-            stage1_user_prompt_for_history = f"User: Request for key parameters for detailed comparison of {mfg_pn1} vs {mfg_pn2}."
-
-            parameters_response_text = self.send_to_ai(
-                [stage1_prompt_text],
-                is_initial_analysis=False, # This is part of detailed comparison, not initial one
-                user_prompt_for_history=stage1_user_prompt_for_history
-            )
-
-            if not parameters_response_text or parameters_response_text.startswith("AI Error:") or "empty/no content" in parameters_response_text :
-                self.update_conversation_history("System: Stage 1 Failed: Could not fetch relevant parameters from AI. Aborting detailed comparison.", role="error")
-                if not parameters_response_text: # send_to_ai might return None
-                     self.update_conversation_history("System: Failed to get parameters from AI (no response).", role="error")
+            # The answer depends only on these inputs; repeating the request in the same conversation reuses it
+            memo_key = (self.model.model_name, self.spec_sheet_1_text, self.spec_sheet_2_text, mfg_pn1, mfg_pn2, self._translation_instruction())
+            if self._detailed_comparison_memo is not None and self._detailed_comparison_memo[0] == memo_key:
+                self.update_conversation_history(f"System: Datasheets, part numbers and model unchanged; reusing the previous detailed comparison for {mfg_pn1} vs {mfg_pn2}.", role="system")
+                request_sent = True # _on_detailed_comparison_response re-enables the button
+                self._on_detailed_comparison_response(self._detailed_comparison_memo[1])
                 return
 
-            # Clean up parameter list - remove potential numbering, newlines, and make it a comma separated string
-            identified_parameters = re.sub(r"^\s*[\d.\-\s)]+\s*", "", parameters_response_text.strip(), flags=re.MULTILINE) # Remove leading numbers/bullets
-            identified_parameters = identified_parameters.replace('\n', ', ').replace(';','_').replace('，',',').strip() # Replace newlines/other separators with commas
-            identified_parameters = ", ".join(filter(None, [p.strip() for p in identified_parameters.split(',')])) # Ensure clean comma separation
-
-            if not identified_parameters:
-                self.update_conversation_history("System: Stage 1 Warning: AI did not return any parameters. Proceeding with general comparison.", role="system")
-                # Fallback: if AI returns no params, provide a generic list or let stage 2 proceed without specific guidance.
-                # For now, we'll let stage 2 proceed and it will ask for general differences.
-            else:
-                self.update_conversation_history(f"System: AI identified parameters: {identified_parameters}", role="system")
-
-            # Stage 2: Fetch Detailed Differences Based on Parameters
-            self.update_conversation_history(f"System: Stage 2: Fetching detailed differences for {mfg_pn1} vs {mfg_pn2} based on identified parameters...", role="system")
+            # Parameter identification and the detailed comparison are fused into a single request:
+            # the datasheets dominate the token count, so sending them once halves input tokens and latency.
+            self.update_conversation_history(f"System: Fetching relevant parameters and detailed differences for {mfg_pn1} vs {mfg_pn2}...", role="system")
 
-            datasheet_sourcing_instruction = (
-                "IMPORTANT INSTRUCTIONS FOR AI RESPONSE:\n"
-                "- Base your answers primarily on the information extracted from the provided component datasheets "
-                "(text, images, and context from previous turns).\n"
-                "- If the datasheets lack specific information to answer a point, you may use your general knowledge.\n"
-                "- If you use general knowledge, you MUST explicitly state for which points the information was not found "
-                "in the datasheets and that your answer for those points is based on general understanding.\n"
-            )
-
-            stage2_prompt_parts = [
-                f"You are comparing two electronic components: MFG P/N 1: {mfg_pn1} and MFG P/N 2: {mfg_pn2}.\n\n"
-                "--- COMPONENT 1 DATASHEET TEXT START ---\n"
-                f"{self.spec_sheet_1_text}\n"
-                "--- COMPONENT 1 DATASHEET TEXT END ---\n\n"
-                "--- COMPONENT 2 DATASHEET TEXT START ---\n"
-                f"{self.spec_sheet_2_text}\n"
-                "--- COMPONENT 2 DATASHEET TEXT END ---\n\n",
-                datasheet_sourcing_instruction,
+            # send_to_ai puts the static datasheet block ahead of these request-specific parts
+            comparison_prompt_parts = [
+                f"You are comparing the two electronic components above: MFG P/N 1: {mfg_pn1} and MFG P/N 2: {mfg_pn2}.\n\n",
+                *self.DETAILED_COMPARISON_TASKS,
             ]
 
-            if identified_parameters:
-                 stage2_prompt_parts.append(f"Focus on the following parameters that were identified for these components: {identified_parameters}.\n")
-            else:
-                 stage2_prompt_parts.append("Focus on crucial electrical and physical parameters relevant for comparing these specific component types.\n")
-
-            stage2_prompt_parts.extend([
-                "Based PRIMARILY on the provided datasheet texts above, please perform the following:",
-                "1. List all key specification differences (especially considering the parameters above if provided) in a clear, concise markdown table format. Ensure the table includes columns for Parameter, Value for Component 1, and Value for Component 2. Include a 'Notes' or 'Difference' column if applicable.",
-                "2. Explicitly state their full Operating Temperature ranges (e.g., -40°C to 125°C).",
-                "3. Assess SMT Compatibility: Can Component 2's package (based on its description in provided text/images - though prioritize the full texts now re-provided) likely be SMT'd onto Component 1's typical PCB footprint? Consider common package names and pin counts. State any assumptions clearly.",
-                "4. Package size including leads for two parts"
-            ])
-
-            stage2_user_prompt_for_history = (
-                f"User: Request for detailed specification differences, temp ranges, and SMT compatibility "
-                f"for {mfg_pn1} vs {mfg_pn2}"
-                f"{', based on parameters: ' + identified_parameters if identified_parameters else '.'}"
+            comparison_user_prompt_for_history = (
+                f"User: Request for key parameters, detailed specification differences, temp ranges, and SMT compatibility "
+                f"for {mfg_pn1} vs {mfg_pn2}."
             )
 
-            detailed_comparison_response_text = self.send_to_ai(
-                stage2_prompt_parts,
+            request_sent = self.send_to_ai(
+                comparison_prompt_parts,
                 is_initial_analysis=False,
-                user_prompt_for_history=stage2_user_prompt_for_history
+                user_prompt_for_history=comparison_user_prompt_for_history,
+                on_response=lambda response_text: self._on_detailed_comparison_response(response_text, memo_key)
             )
-            print("DEBUG:",detailed_comparison_response_text)
-            if detailed_comparison_response_text and not detailed_comparison_response_text.startswith("AI Error:"):
-                self._populate_comparison_treeview(detailed_comparison_response_text)
-            else:
-                if not detailed_comparison_response_text:
-                    self.update_conversation_history("System: Stage 2 Failed: Failed to get detailed comparison from AI (no response).", role="error")
-                # Error message already logged by send_to_ai if it starts with "AI Error:"
         finally:
-            if self.model and hasattr(self, 'start_comparison_button'):
+            if not request_sent and self.model and self.start_comparison_button is not None:
                 self.start_comparison_button.config(state=tk.NORMAL)
 
+    def _on_detailed_comparison_response(self, detailed_comparison_response_text, memo_key=None):
+        """Tk-thread continuation of on_start_detailed_comparison once the AI has answered; an answer with a table is memoized under memo_key."""
+        try:
+            logger.debug("Detailed comparison response: %s", detailed_comparison_response_text)
+            if not detailed_comparison_response_text or detailed_comparison_response_text.startswith("AI Error:") or "empty/no content" in detailed_comparison_response_text:
+                if not detailed_comparison_response_text: # No response text at all
+                    self.update_conversation_history("System: Detailed comparison failed: Failed to get detailed comparison from AI (no response).", role="error")
+                # Error message already logged by send_to_ai if it starts with "AI Error:"
+                return
 
-    def _parse_markdown_table(self, markdown_text: str) -> tuple[dict or None, int]:
-        # Filter out empty lines and strip whitespace
-        # Keep track of original lines to count consumption accurately based on input structure
-        original_lines = markdown_text.splitlines()
-        processed_lines_info = [] # Stores (stripped_line_text, original_line_index)
-
-        for original_idx, line_text in enumerate(original_lines):
-            stripped = line_text.strip()
-            if stripped: # Only consider non-empty lines for parsing logic
-                processed_lines_info.append({'text': stripped, 'original_index': original_idx})
+            identified_parameters, comparison_table_text = self._split_detailed_comparison_response(detailed_comparison_response_text)
+            if not identified_parameters:
+                self.update_conversation_history("System: Warning: AI did not return a parameter list. Using the comparison as returned.", role="system")
+            else:
+                self.update_conversation_history(f"System: AI identified parameters: {identified_parameters}", role="system")
 
-        if not processed_lines_info:
-            return None, 0
+            # Only an answer that produced a table is reused, so pressing the button again is a real retry otherwise
+            if self._populate_comparison_treeview(comparison_table_text) and memo_key is not None:
+                self._detailed_comparison_memo = (memo_key, detailed_comparison_response_text)
+        finally:
+            if self.model and self.start_comparison_button is not None:
+                self.start_comparison_button.config(state=tk.NORMAL)
 
-        header_line_proc_index = -1 # Index in processed_lines_info
-        separator_line_proc_index = -1
-        
-        separator_pattern = r"^\s*\|(\s*[:\-]+\s*\|)*\s*[:\-]+\s*\|\s*$"
 
-        # Find header and separator lines using processed_lines_info
-        for i, current_line_info in enumerate(processed_lines_info):
-            current_line_text = current_line_info['text']
-            if not current_line_text.startswith('|') or not current_line_text.endswith('|'):
-                continue
-            if current_line_text.count('|') < 2: 
-                continue
+    def _build_datasheet_context_parts(self) -> list[str]:
+        """
+        Returns the datasheet texts that send_to_ai puts ahead of every request.
+        The block is identical for every request on the same pair of spec sheets, so it is uploaded once
+        as a Gemini context cache (or reused by prefix caching when it is sent inline).
+        The texts are separate parts so the (large) extracted strings are not copied into a combined string.
+        """
+        return [
+            "--- COMPONENT 1 DATASHEET TEXT START ---\n",
+            self.spec_sheet_1_text,
+            "\n--- COMPONENT 1 DATASHEET TEXT END ---\n\n"
+            "--- COMPONENT 2 DATASHEET TEXT START ---\n",
+            self.spec_sheet_2_text,
+            "\n--- COMPONENT 2 DATASHEET TEXT END ---\n\n",
+        ]
+
+    def _split_detailed_comparison_response(self, response_text: str) -> tuple[str, str]:
+        """
+        Splits a fused detailed-comparison response into (identified_parameters, table_text).
+        Falls back to the whole response as table text if the TABLE label line is missing.
+        """
+        label_match = self.DETAILED_TABLE_LABEL_RE.search(response_text)
+        if label_match is not None:
+            head, tail = response_text[:label_match.start()], response_text[label_match.end():]
+        else: # The parameter line may still be there; the table is then looked up in the whole response
+            head = tail = response_text
+
+        parameters_text = ""
+        for line in head.splitlines():
+            stripped = line.strip().replace("**", "")
+            if stripped.upper().startswith(self.DETAILED_PARAMETERS_LABEL):
+                parameters_text = stripped[len(self.DETAILED_PARAMETERS_LABEL):]
+                break
 
-            if (i + 1) < len(processed_lines_info):
-                next_line_info = processed_lines_info[i+1]
-                next_line_text = next_line_info['text']
-                if re.fullmatch(separator_pattern, next_line_text):
-                    temp_headers = [h.strip() for h in current_line_text[1:-1].split('|')]
-                    num_header_cols = len(temp_headers)
-                    num_separator_cols = next_line_text.count('|') - 1
-                    
-                    if num_header_cols == num_separator_cols and num_header_cols > 0:
-                        header_line_proc_index = i
-                        separator_line_proc_index = i + 1
-                        break
-        
-        if header_line_proc_index == -1:
-            return None, 0
+        # Clean up parameter list - remove potential numbering, newlines, and make it a comma separated string
+        identified_parameters = _PARAMETER_BULLET_RE.sub("", parameters_text.strip()) # Remove leading numbers/bullets
+        identified_parameters = identified_parameters.translate(_PARAMETER_SEPARATOR_TRANSLATION) # Replace newlines/other separators with commas
+        identified_parameters = ", ".join(filter(None, [p.strip() for p in identified_parameters.split(',')])) # Ensure clean comma separation
+        return identified_parameters, tail.strip()
 
-        header_text_from_processed = processed_lines_info[header_line_proc_index]['text']
-        headers = [h.strip() for h in header_text_from_processed[1:-1].split('|')]
-        num_cols = len(headers)
+    def _parse_markdown_table(self, markdown_text: str | list[str]) -> tuple[ParsedTable | None, int]:
+        """
+        Parses the first markdown pipe table in markdown_text (a string or a list of lines).
+        Returns (table or None, number of input lines consumed up to the end of the table).
+        """
+        if isinstance(markdown_text, str):
+            # Cheap bail-out: a header plus separator row needs at least 4 pipes
+            if not markdown_text or markdown_text.count('|') < 4:
+                return None, 0
+            original_lines = markdown_text.splitlines()
+        else:
+            original_lines = markdown_text
 
+        # Single forward pass over the non-empty (stripped) lines: look for a header row directly followed by a
+        # matching separator row, then collect data rows until the first line that doesn't fit the table
+        header_candidate = None # Previous non-empty line, if it could be a header row
+        headers = None
         table_rows_data = []
-        last_processed_row_proc_index = separator_line_proc_index
-
-        # Process rows after the separator line, using processed_lines_info
-        for i in range(separator_line_proc_index + 1, len(processed_lines_info)):
-            current_row_info = processed_lines_info[i]
-            current_row_text = current_row_info['text']
-
-            if current_row_text.startswith('|') and current_row_text.endswith('|'):
-                if current_row_text.count('|') != num_cols + 1:
-                    break 
-                cells = [cell.strip() for cell in current_row_text[1:-1].split('|')]
-                if len(cells) == num_cols:
-                     table_rows_data.append(cells)
-                else: # Fallback for mismatched cell count (should be rare with pipe check)
-                    if len(cells) < num_cols: cells.extend([""] * (num_cols - len(cells)))
-                    else: cells = cells[:num_cols]
-                    table_rows_data.append(cells)
-                last_processed_row_proc_index = i # Update index of the last successfully processed row
+        last_table_line_index = -1 # Original index of the last header/separator/data line of the table
+
+        for original_idx, line_text in enumerate(original_lines):
+            stripped = line_text.strip()
+            if not stripped:
+                continue
+            if headers is None:
+                if stripped[0] != '|': # Prose line: can be neither a header nor a separator row
+                    header_candidate = None
+                    continue
+                # Header columns = pipes - 1 on both rows, e.g. "| A | B |" and "|---|---|"
+                if header_candidate is not None and header_candidate.count('|') == stripped.count('|') and _TABLE_SEPARATOR_RE.fullmatch(stripped):
+                    headers = [h.strip() for h in header_candidate[1:-1].split('|')]
+                    num_pipes = len(headers) + 1
+                    last_table_line_index = original_idx
+                elif stripped.endswith('|') and stripped.count('|') >= 2:
+                    header_candidate = stripped
+                else:
+                    header_candidate = None
+            elif stripped.startswith('|') and stripped.endswith('|') and stripped.count('|') == num_pipes:
+                table_rows_data.append([cell.strip() for cell in stripped[1:-1].split('|')])
+                last_table_line_index = original_idx
             else:
                 break
 
-        # Determine lines consumed from the original input string
-        # The table ends at the original line index of the last processed row (header, separator, or data row)
-        # If no rows, table ends at separator. If rows, table ends at last data row.
-        # The number of lines consumed is the original_index of the last part of the table + 1
-        # (because original_index is 0-based).
-
-        # If table_rows_data is not empty, the table consumed lines up to the last data row.
-        # The index in processed_lines_info for this last data row is `last_processed_row_proc_index`.
-        # If table_rows_data is empty, the table consumed lines up to the separator line.
-        # The index in processed_lines_info for the separator is `separator_line_proc_index`.
-
-        # `last_processed_row_proc_index` is initialized to `separator_line_proc_index`
-        # and updated if any data rows are found and processed.
-        # So, `processed_lines_info[last_processed_row_proc_index]['original_index']` gives the
-        # 0-based index in the *original* `markdown_text.splitlines()` of the last line
-        # that is part of the parsed table.
-        lines_consumed_count = processed_lines_info[last_processed_row_proc_index]['original_index'] + 1
-
-        return {'type': 'table', 'headers': headers, 'rows': table_rows_data}, lines_consumed_count
+        if headers is None:
+            return None, 0
+        return ParsedTable(headers, table_rows_data), last_table_line_index + 1
 
-    def _parse_implicit_table(self, text_lines: list[str]) -> dict or None:
+    def _parse_implicit_table(self, text_lines: list[str]) -> ParsedTable | None:
         MIN_IMPLICIT_TABLE_ROWS = 2 # Minimum number of qualifying lines to form a table
-        # Regex to capture key and value parts. Allows for optional whitespace around colon.
-        # Key is group 1, Value is group 2.
-        # Key can be anything up to the colon. Value is everything after.
-        KEY_VALUE_SEPARATOR_PATTERN = re.compile(r"^\s*(.+?)\s*:\s*(.+)\s*$")
 
         if not text_lines or len(text_lines) < MIN_IMPLICIT_TABLE_ROWS:
             return None
@@ -542,7 +1036,7 @@ class ComponentComparatorAI:
                     start_line_idx = -1 # Reset start if a blank line interrupts before min rows
                 continue
 
-            match = KEY_VALUE_SEPARATOR_PATTERN.match(line_stripped)
+            match = _KEY_VALUE_LINE_RE.match(line_stripped)
             if match:
                 key_part = match.group(1).strip()
                 value_part = match.group(2).strip()
@@ -584,50 +1078,47 @@ class ComponentComparatorAI:
             # The number of lines consumed by this implicit table is tricky if there were interspersed blank lines
             # or leading/trailing non-matching lines. For now, this function doesn't return consumed lines.
             # _format_ai_response will have to manage line consumption more carefully if this parser is used.
-            return {'type': 'table', 'headers': headers, 'rows': parsed_rows_data}
+            return ParsedTable(headers, parsed_rows_data)
 
         return None
 
-    def _populate_comparison_treeview(self, ai_response_text: str):
+    def _populate_comparison_treeview(self, ai_response_text: str) -> bool:
+        """Fills the comparison Treeview from the first markdown table in ai_response_text; returns False if there is none."""
         if hasattr(self, 'comparison_treeview'):
-            for item in self.comparison_treeview.get_children(): self.comparison_treeview.delete(item)
-        else: self.update_conversation_history("System: Treeview not found.", role="error"); return
+            self.comparison_treeview.delete(*self.comparison_treeview.get_children())
+        else: self.update_conversation_history("System: Treeview not found.", role="error"); return False
         
         # Attempt to parse the response as a generic markdown table first
-        # MODIFIED to handle tuple return from _parse_markdown_table
-        parsing_result = self._parse_markdown_table(ai_response_text)
-        parsed_table_data = None # Initialize
-        lines_consumed = 0 # Initialize
-
-        if isinstance(parsing_result, tuple) and len(parsing_result) == 2:
-            parsed_table_data, lines_consumed = parsing_result # Unpack tuple
-        elif isinstance(parsing_result, dict):
-            # Fallback: if _parse_markdown_table somehow returned only a dict (older version or specific path)
-            parsed_table_data = parsing_result
-            print("DEBUG: _populate_comparison_treeview - _parse_markdown_table returned a dict directly.")
-        elif parsing_result is None:
-            # _parse_markdown_table returned None directly (e.g. if input was empty, or no table found which now returns (None,0))
-            # This specific None case might be less likely now with (None,0) return for "no table found"
-            print("DEBUG: _populate_comparison_treeview - _parse_markdown_table returned None directly.")
-        else:
-            # Unexpected return type
-            print(f"DEBUG: _populate_comparison_treeview - Unexpected return type from _parse_markdown_table: {type(parsing_result)}")
+        parsed_table_data, _ = self._parse_markdown_table(ai_response_text)
 
-        # Ensure parsed_table_data is a dict and has 'headers' and 'rows' keys before proceeding
-        if not parsed_table_data or not isinstance(parsed_table_data, dict) or \
-           not parsed_table_data.get('headers') or not parsed_table_data.get('rows'):
+        # Ensure parsed_table_data is a table with headers and rows before proceeding
+        if parsed_table_data is None or not parsed_table_data.headers or not parsed_table_data.rows:
             self.update_conversation_history("System: No valid table data parsed for Treeview or table is empty/malformed.", role="system")
-            return
+            return False
 
         pn1 = self.mfg_pn_var_1.get() or (os.path.basename(self.spec_sheet_1_path) if self.spec_sheet_1_path else "Comp 1")
         pn2 = self.mfg_pn_var_2.get() or (os.path.basename(self.spec_sheet_2_path) if self.spec_sheet_2_path else "Comp 2")
-        
-        headers = parsed_table_data.get('headers', []) # Use .get for safety
-        
-        self.comparison_treeview.heading("component1", text=f"{pn1[:25]}{'...' if len(pn1)>25 else ''}")
-        self.comparison_treeview.heading("component2", text=f"{pn2[:25]}{'...' if len(pn2)>25 else ''}")
 
-        for row_data in parsed_table_data.get('rows', []): # Use .get for safety
+        self.comparison_treeview.heading("component1", text=_shorten_heading(pn1))
+        self.comparison_treeview.heading("component2", text=_shorten_heading(pn2))
+
+        # Rows are inserted in chunks from the Tk idle loop so large tables don't block the UI.
+        # The Treeview is unmapped meanwhile so it is laid out and redrawn once, not after every chunk.
+        self.comparison_treeview.grid_remove()
+        self._pending_treeview_rows = iter(parsed_table_data.rows)
+        self.root.after_idle(self._insert_comparison_rows_chunk, self._pending_treeview_rows)
+        return True
+
+    def _insert_comparison_rows_chunk(self, rows_iter, chunk_size=TREEVIEW_INSERT_CHUNK_SIZE):
+        """Inserts up to chunk_size rows into the comparison Treeview, rescheduling itself until done."""
+        if rows_iter is not self._pending_treeview_rows:
+            return # Superseded by a newer table or cleared
+        for _ in range(chunk_size):
+            row_data = next(rows_iter, None)
+            if row_data is None:
+                self._stop_comparison_rows_insert()
+                self.update_conversation_history("System: Detailed comparison table populated.", role="system")
+                return
             # Map row_data list to the tuple expected by treeview.insert
             # (parameter, component1_val, component2_val, notes)
             parameter = row_data[0] if len(row_data) > 0 else ""
@@ -635,145 +1126,162 @@ class ComponentComparatorAI:
             comp2_val = row_data[2] if len(row_data) > 2 else ""
             notes = row_data[3] if len(row_data) > 3 else ""
             self.comparison_treeview.insert("", tk.END, values=(parameter, comp1_val, comp2_val, notes))
-            
-        self.update_conversation_history("System: Detailed comparison table populated.", role="system")
+        self.root.after_idle(self._insert_comparison_rows_chunk, rows_iter)
 
-    def load_spec_sheet_1(self):
-        filepath = filedialog.askopenfilename(title="Select Spec Sheet 1 (PDF)", filetypes=[("PDF files", "*.pdf"), ("All files", "*.*")])
-        if filepath:
-            self.spec_sheet_1_path = filepath
-            self.spec_sheet_1_label.config(text=f"File 1: {os.path.basename(filepath)}")
-            if self.spec_sheet_1_path and self.spec_sheet_2_path:
-                self.model_combobox.config(state='readonly')
-                self.update_conversation_history("System: Both spec sheets loaded. Please select an AI model.", role="system")
-        else:
-            self.spec_sheet_1_label.config(text=f"File 1: {os.path.basename(self.spec_sheet_1_path) if self.spec_sheet_1_path else 'None'}")
+    def _stop_comparison_rows_insert(self):
+        """Ends (or cancels) chunked row insertion and re-shows the comparison Treeview."""
+        self._pending_treeview_rows = None
+        if hasattr(self, 'comparison_treeview'): self.comparison_treeview.grid() # Restores the grid options kept by grid_remove()
 
-    def load_spec_sheet_2(self):
-        filepath = filedialog.askopenfilename(title="Select Spec Sheet 2 (PDF)", filetypes=[("PDF files", "*.pdf"), ("All files", "*.*")])
-        if filepath:
-            self.spec_sheet_2_path = filepath
-            self.spec_sheet_2_label.config(text=f"File 2: {os.path.basename(filepath)}")
-            if self.spec_sheet_1_path and self.spec_sheet_2_path:
-                self.model_combobox.config(state='readonly')
-                self.update_conversation_history("System: Both spec sheets loaded. Please select an AI model.", role="system")
-        else:
-            self.spec_sheet_2_label.config(text=f"File 2: {os.path.basename(self.spec_sheet_2_path) if self.spec_sheet_2_path else 'None'}")
+    def load_spec_sheet_1(self): self._load_spec_sheet(1)
+    def load_spec_sheet_2(self): self._load_spec_sheet(2)
 
-    
-    def _is_text_segment_redundant_with_table(self, text_lines: list[str], table_data: dict) -> bool:
+    def _load_spec_sheet(self, sheet_number: int):
+        """Asks for spec sheet 1 or 2 and stores it in spec_sheet_<n>_path; enables model selection once both are loaded."""
+        from tkinter import filedialog  # Lazy, as in on_upload_image
+        filepath = filedialog.askopenfilename(title=f"Select Spec Sheet {sheet_number} (PDF)", filetypes=[("PDF files", "*.pdf"), ("All files", "*.*")])
+        if not filepath:
+            return # Cancelled; keep the current file and label
+        setattr(self, f"spec_sheet_{sheet_number}_path", filepath)
+        getattr(self, f"spec_sheet_{sheet_number}_label").config(text=f"File {sheet_number}: {os.path.basename(filepath)}")
+        if self.spec_sheet_1_path and self.spec_sheet_2_path:
+            self.model_combobox.config(state='readonly')
+            self.update_conversation_history("System: Both spec sheets loaded. Please select an AI model.", role="system")
+
+    def _get_table_normalization(self, table_data: ParsedTable) -> TableNormalization:
+        """Returns the normalized lookups of table_data, computing and attaching them on first use."""
+        if table_data._normalized is None:
+            column_index = {}
+            for idx, header in enumerate(table_data.headers):
+                column_index.setdefault(str(header).strip().lower(), idx)
+            row_index = {}
+            if table_data.rows and len(table_data.rows[0]) > 0:
+                for idx, row in enumerate(table_data.rows):
+                    if row:
+                        row_index.setdefault(str(row[0]).strip().lower(), idx)
+            cells_norm = frozenset(str(cell).strip().lower() for row in table_data.rows for cell in row)
+            table_data._normalized = TableNormalization(frozenset(column_index), cells_norm, column_index, row_index, SubstringMatcher(cells_norm))
+        return table_data._normalized
+
+    def _get_focused_table_cells(self, table_data: ParsedTable, axis: str, index: int) -> tuple[frozenset[str], SubstringMatcher]:
+        """Returns the normalized non-empty cells of one table column ("column") or row ("row", first cell excluded), cached on the table."""
+        focused_cells = self._get_table_normalization(table_data).focused_cells
+        key = (axis, index)
+        if key not in focused_cells:
+            if axis == "column":
+                raw_cells = (row[index] for row in table_data.rows if len(row) > index)
+            else:
+                raw_cells = table_data.rows[index][1:]
+            cells_norm = frozenset(cell_norm for cell_norm in (str(cell).strip().lower() for cell in raw_cells) if cell_norm)
+            focused_cells[key] = (cells_norm, SubstringMatcher(cells_norm))
+        return focused_cells[key]
+
+    def _is_text_segment_redundant_with_table(self, text_lines: list[str], table_data: ParsedTable) -> bool:
         MAX_LINES_FOR_REDUNDANCY_CHECK = 7
         MIN_REDUNDANCY_THRESHOLD_PERCENT = 0.75
         MIN_REDUNDANCY_FOR_SECTION_MATCH = 0.51
 
+        if not text_lines or (not table_data.headers and not table_data.rows):
+            return False # Nothing to compare; skip building line lists and table normalization
+
         actual_text_lines = [line for line in text_lines if line.strip()]
         if not actual_text_lines:
             return False
 
-        is_potentially_headed_section = False
-        first_line_normalized_for_header_check = actual_text_lines[0].strip().lower()
-        if (first_line_normalized_for_header_check.startswith('**') and first_line_normalized_for_header_check.endswith('**') and len(first_line_normalized_for_header_check) > 4) or        (first_line_normalized_for_header_check.startswith('## ') and len(first_line_normalized_for_header_check) > 3):
-            is_potentially_headed_section = True
+        first_line_orig_case = actual_text_lines[0].strip()
+        section_header_match = _SECTION_HEADER_RE.fullmatch(first_line_orig_case)
+        is_potentially_headed_section = section_header_match is not None
 
         if not is_potentially_headed_section and len(actual_text_lines) > MAX_LINES_FOR_REDUNDANCY_CHECK:
             return False
 
-        table_headers_normalized = {str(h).strip().lower(): str(h).strip() for h in table_data.get('headers', [])}
-        table_all_cells_normalized_set = set()
-        for row in table_data.get('rows', []):
-            for cell in row:
-                table_all_cells_normalized_set.add(str(cell).strip().lower())
+        table_norm = self._get_table_normalization(table_data)
+        table_headers_normalized = table_norm.headers
+        table_all_cells_normalized_set = table_norm.cells
 
         if not table_all_cells_normalized_set and not table_headers_normalized:
             return False
 
         potential_section_title_normalized = None
-        first_line_orig_case = actual_text_lines[0].strip()
-
-        if first_line_orig_case.startswith('**') and first_line_orig_case.endswith('**') and len(first_line_orig_case) > 4:
-            potential_section_title_normalized = first_line_orig_case[2:-2].strip().lower()
-        elif first_line_orig_case.startswith('## ') and len(first_line_orig_case) > 3:
-            potential_section_title_normalized = first_line_orig_case[3:].strip().lower()
+        if section_header_match:
+            potential_section_title_normalized = (section_header_match.group(1) or section_header_match.group(2)).strip().lower()
 
         lines_to_check_for_content = actual_text_lines
         focused_table_content_normalized = None
+        focused_table_content_matcher = None
         is_section_header_matched = False
 
         if potential_section_title_normalized:
             if potential_section_title_normalized in table_headers_normalized:
                 is_section_header_matched = True
-                try:
-                    col_idx = -1
-                    for idx, header_val in enumerate(table_data.get('headers', [])):
-                        if str(header_val).strip().lower() == potential_section_title_normalized:
-                            col_idx = idx
-                            break
-                    if col_idx != -1:
-                        focused_table_content_normalized = {str(row[col_idx]).strip().lower() for row in table_data.get('rows', []) if len(row) > col_idx and str(row[col_idx]).strip()}
-                except Exception:
-                    pass
+                col_idx = table_norm.column_index.get(potential_section_title_normalized, -1)
+                if col_idx != -1:
+                    focused_table_content_normalized, focused_table_content_matcher = self._get_focused_table_cells(table_data, "column", col_idx)
                 lines_to_check_for_content = actual_text_lines[1:]
             else:
-                if table_data.get('rows') and len(table_data['rows'][0]) > 0:
-                    for row_data in table_data.get('rows', []):
-                        if str(row_data[0]).strip().lower() == potential_section_title_normalized:
-                            is_section_header_matched = True
-                            focused_table_content_normalized = {str(cell).strip().lower() for cell in row_data[1:] if str(cell).strip()}
-                            lines_to_check_for_content = actual_text_lines[1:]
-                            break
-
-        if is_section_header_matched and not [line for line in lines_to_check_for_content if line.strip()]:
+                row_idx = table_norm.row_index.get(potential_section_title_normalized, -1)
+                if row_idx != -1:
+                    is_section_header_matched = True
+                    focused_table_content_normalized, focused_table_content_matcher = self._get_focused_table_cells(table_data, "row", row_idx)
+                    lines_to_check_for_content = actual_text_lines[1:]
+
+        # lines_to_check_for_content is (a suffix of) actual_text_lines, so it holds no blank lines
+        if is_section_header_matched and not lines_to_check_for_content:
             return True # Header matched, no content lines, considered redundant
 
-        if len([line for line in lines_to_check_for_content if line.strip()]) > MAX_LINES_FOR_REDUNDANCY_CHECK and not is_section_header_matched:
+        if len(lines_to_check_for_content) > MAX_LINES_FOR_REDUNDANCY_CHECK and not is_section_header_matched:
              return False
 
         redundant_lines_count = 0
-        comparison_basis_set = focused_table_content_normalized if focused_table_content_normalized is not None else table_all_cells_normalized_set
+        if focused_table_content_normalized is not None:
+            comparison_basis_set = focused_table_content_normalized
+            comparison_basis_matcher = focused_table_content_matcher
+        else:
+            comparison_basis_set = table_all_cells_normalized_set
+            comparison_basis_matcher = table_norm.cell_matcher
 
         if not comparison_basis_set:
             if is_section_header_matched :
                  return False
 
-        content_lines_for_final_check = [line for line in lines_to_check_for_content if line.strip()][:MAX_LINES_FOR_REDUNDANCY_CHECK]
+        content_lines_for_final_check = lines_to_check_for_content[:MAX_LINES_FOR_REDUNDANCY_CHECK]
         if not content_lines_for_final_check:
             return False
 
-        for line_content in content_lines_for_final_check:
-            normalized_line = line_content.strip().lower()
-            if normalized_line in comparison_basis_set:
-                redundant_lines_count += 1; continue
+        current_threshold = MIN_REDUNDANCY_FOR_SECTION_MATCH if is_section_header_matched and focused_table_content_normalized is not None else MIN_REDUNDANCY_THRESHOLD_PERCENT
+        total_lines = len(content_lines_for_final_check)
+        # Smallest redundant-line count reaching the threshold, so the loop can stop once the outcome is decided
+        needed_redundant_lines = next((n for n in range(total_lines + 1) if float(n) / total_lines >= current_threshold), total_lines + 1)
 
-            found_substring_match = False
-            for table_val in comparison_basis_set:
-                if table_val and (table_val in normalized_line or normalized_line in table_val):
-                    found_substring_match = True; break
-            if found_substring_match:
-                redundant_lines_count += 1; continue
+        for line_idx, line_content in enumerate(content_lines_for_final_check):
+            normalized_line = line_content.strip().lower()
+            # Exact cell match, or table value in line / line in a table value
+            is_line_redundant = normalized_line in comparison_basis_set or comparison_basis_matcher.matches(normalized_line)
 
-            if focused_table_content_normalized is None and ':' in normalized_line: # Only do key:value check for general text
+            if not is_line_redundant and focused_table_content_normalized is None and ':' in normalized_line: # Only do key:value check for general text
                 parts = normalized_line.split(':', 1)
                 if len(parts) == 2:
                     key_norm = parts[0].strip()
                     val_norm = parts[1].strip()
                     # Check if key is a table header and value is in any cell, or both in general cells
-                    if (key_norm in table_headers_normalized and val_norm in table_all_cells_normalized_set) or                    (key_norm in table_all_cells_normalized_set and val_norm in table_all_cells_normalized_set):
-                        redundant_lines_count += 1; continue
+                    is_line_redundant = (key_norm in table_headers_normalized and val_norm in table_all_cells_normalized_set) or \
+                                        (key_norm in table_all_cells_normalized_set and val_norm in table_all_cells_normalized_set)
 
-        current_threshold = MIN_REDUNDANCY_FOR_SECTION_MATCH if is_section_header_matched and focused_table_content_normalized is not None else MIN_REDUNDANCY_THRESHOLD_PERCENT
-
-        if (float(redundant_lines_count) / len(content_lines_for_final_check)) >= current_threshold:
-            return True
+            if is_line_redundant:
+                redundant_lines_count += 1
+                if redundant_lines_count >= needed_redundant_lines:
+                    return True
+            elif redundant_lines_count + (total_lines - line_idx - 1) < needed_redundant_lines:
+                return False # Threshold can no longer be reached
 
         return False
 
-    def _finalize_text_block(self, block_lines: list[str], last_table_segment_for_redundancy_check: dict or None) -> dict or None:
+    def _finalize_text_block(self, block_lines: list[str], last_table_segment_for_redundancy_check: ParsedTable | None) -> ParsedTable | TextSegment | None:
         if not [line for line in block_lines if line.strip()]:
             return None
 
         implicit_table = self._parse_implicit_table(block_lines)
         if implicit_table:
-            # REMOVED: print(f"DEBUG: _finalize_text_block: Added IMPLICIT TABLE. Headers: {{implicit_table.get('headers')}}")
             return implicit_table
 
         collected_text = "\n".join(block_lines).strip()
@@ -782,223 +1290,167 @@ class ComponentComparatorAI:
             if last_table_segment_for_redundancy_check:
                 is_redundant = self._is_text_segment_redundant_with_table(block_lines, last_table_segment_for_redundancy_check)
 
-            if not is_redundant:
-                # REMOVED: print(f"DEBUG: _finalize_text_block: Added TEXT segment: '{{collected_text[:70]}}...'")
-                return {'type': 'text', 'content': collected_text}
-            else:
-                # REMOVED: print(f"DEBUG: _finalize_text_block: Suppressed redundant TEXT segment: '{{collected_text[:70]}}...'")
-                pass # Explicitly do nothing if text is redundant and suppressed
+            if not is_redundant: # Text that only repeats the preceding table is suppressed
+                return TextSegment(collected_text)
         return None
 
-    def _format_ai_response(self, text_response: str) -> list:
-        segments = []
-        current_text_block_lines = [] # Accumulates lines for a potential text or implicit table segment
-        all_lines = text_response.splitlines()
-        i = 0
-        last_processed_table_segment = None # For redundancy checks of text vs preceding table
-
-        while i < len(all_lines):
-            # Check for a standard markdown (pipe) table starting at the current line
-            # _parse_markdown_table expects a single string, so we join lines from current position
-            pipe_table_data, lines_consumed_by_parser = self._parse_markdown_table("\n".join(all_lines[i:]))
-
-            if pipe_table_data:
-                # A pipe table was found. First, finalize any text block accumulated *before* this pipe table.
-                if current_text_block_lines:
-                    processed_segment = self._finalize_text_block(current_text_block_lines, last_processed_table_segment)
-                    if processed_segment:
-                        segments.append(processed_segment)
-                        if processed_segment['type'] == 'table': # This would be an implicit table
-                            last_processed_table_segment = processed_segment
-                    current_text_block_lines = [] # Reset buffer
-
-                # Now, add the pipe table itself
-                segments.append(pipe_table_data)
-                last_processed_table_segment = pipe_table_data # Update for next redundancy checks
-                
-                # Use the accurate lines_consumed_by_parser from the parsing method
-                # REMOVED: print(f"DEBUG: _format_ai_response: Added PIPE TABLE segment. Headers: {pipe_table_data.get('headers')}, Consumed: {lines_consumed_by_parser} lines")
-                i += lines_consumed_by_parser # Advance 'i' by the number of lines consumed by the table parser
-
-            else: # No pipe table starts at all_lines[i]
-                line = all_lines[i]
-                if not line.strip(): # Current line is blank, signifies end of a text block
-                    if current_text_block_lines:
-                        processed_segment = self._finalize_text_block(current_text_block_lines, last_processed_table_segment)
-                        if processed_segment:
-                            segments.append(processed_segment)
-                            if processed_segment['type'] == 'table': # Implicit table
-                                last_processed_table_segment = processed_segment
-                        current_text_block_lines = [] # Reset buffer
-                else: # Non-blank line, add to current text block
-                    current_text_block_lines.append(line)
-                i += 1 # Move to the next line
-
-        # After the loop, finalize any remaining lines in current_text_block_lines
-        if current_text_block_lines:
-            processed_segment = self._finalize_text_block(current_text_block_lines, last_processed_table_segment)
-            if processed_segment:
-                segments.append(processed_segment)
-                # No need to update last_processed_table_segment here as it's the end.
-
-        # Debug print for the final list of segments
-        # REMOVED: print(f"DEBUG: _format_ai_response: RETURNING segments (count {len(segments)}): {[s['type'] for s in segments]}") # Log segment types
+    def _format_ai_response(self, text_response: str) -> list[ParsedTable | TextSegment]:
+        segmenter = AIResponseSegmenter(self._finalize_text_block)
+        segments = segmenter.feed(text_response)
+        segments.extend(segmenter.close())
         return segments
 
-    def clean_cell_content(cell_text):
-            # Remove leading/trailing whitespace and markdown bold markers
-            return cell_text.strip().replace("**", "")
-
-    def format_table(table_lines):
-        if not table_lines:
-            return ""
-
-        parsed_table_inner = [] # Renamed
-        for line_inner in table_lines: # Renamed
-            # Remove leading/trailing '|' and split by '|'
-            cells = [clean_cell_content(cell) for cell in line_inner.strip()[1:-1].split('|')]
-            parsed_table_inner.append(cells)
-
-        if not parsed_table_inner:
-            return "\n".join(table_lines) # Should not happen if table_lines is not empty
-
-        num_cols = len(parsed_table_inner[0])
-        # Ensure all rows have the same number of columns, pad if necessary
-        for row_idx, row_inner in enumerate(parsed_table_inner): # Renamed
-            if len(row_inner) < num_cols:
-                parsed_table_inner[row_idx].extend([""] * (num_cols - len(row_inner)))
-            elif len(row_inner) > num_cols: # Should ideally not happen with well-formed tables
-                parsed_table_inner[row_idx] = row_inner[:num_cols]
-
-
-        col_widths = [0] * num_cols
-        for row_inner_widths in parsed_table_inner: # Renamed
-            for i_cell, cell_content in enumerate(row_inner_widths): # Renamed
-                if i_cell < num_cols: # Ensure we don't go out of bounds
-                    col_widths[i_cell] = max(col_widths[i_cell], len(cell_content))
-
-        formatted_table_str_lines = []
-        for i_format_row, row_format_data in enumerate(parsed_table_inner): # Renamed
-            formatted_row_parts = []
-            for j_format_cell, cell_format_data in enumerate(row_format_data): # Renamed
-                if j_format_cell < num_cols: # Ensure we don't go out of bounds
-                    # For separator row, create the separator line based on calculated widths
-                    if separator_pattern_local.match(table_lines[i_format_row].strip()): # Check original line for separator
-                        formatted_row_parts.append('-' * col_widths[j_format_cell])
-                    else:
-                        formatted_row_parts.append(cell_format_data.ljust(col_widths[j_format_cell]))
-            formatted_table_str_lines.append(" | ".join(formatted_row_parts))
-
-        # Re-add outer pipes for aesthetics if desired, or leave as is for simpler alignment
-        return "\n".join([f"| {s} |" for s in formatted_table_str_lines])
-
-
-        for i_outer, line_outer in enumerate(lines): # Renamed
-            stripped_line = line_outer.strip()
-
-            is_table_row_candidate = table_row_pattern.match(stripped_line)
-            is_separator = separator_pattern_local.match(stripped_line)
-
-            if is_table_row_candidate:
-                if not in_table_block:
-                    # Check if this is the start of a new table
-                    # Look ahead for a separator or more table rows
-                    if is_separator or \
-                       (i_outer + 1 < len(lines) and (separator_pattern_local.match(lines[i_outer+1].strip()) or table_row_pattern.match(lines[i_outer+1].strip()))):
-                        in_table_block = True
-                        current_table_lines.append(stripped_line)
-                    else: # Not a table, just a line with pipes
-                        formatted_output_lines.append(re.sub(r'\s*\|\s*', ' | ', stripped_line))
-                else: # Already in a table block
-                    current_table_lines.append(stripped_line)
-            else: # Not a table row candidate
-                if in_table_block:
-                    # Table block has ended
-                    formatted_output_lines.append(format_table(current_table_lines))
-                    current_table_lines = []
-                    in_table_block = False
-                # Add the non-table line (could be empty)
-                formatted_output_lines.append(line_outer) # Keep original non-table lines
-
-        # If the response ends with a table block
-        if in_table_block and current_table_lines:
-            formatted_output_lines.append(format_table(current_table_lines))
-
-        return "\n".join(formatted_output_lines) # This also needs to change
-
     def update_conversation_history(self, message, role="system"):
+        worker_generation = getattr(self._worker_context, 'generation', None)
+        if worker_generation is not None: # Called from a background task: the widget and log belong to the Tk thread
+            self._background_results.put((worker_generation, self.update_conversation_history, (message, role), False))
+            return
         raw_message_for_log = message # Keep the original message for the log
 
         if hasattr(self, 'conversation_history') and self.conversation_history:
-            self.conversation_history.config(state=tk.NORMAL)
             tag_to_apply = {"user": "user_message", "ai": "ai_message", "error": "error_message"}.get(role, "system_message")
 
             if role == "ai":
-                formatted_content_or_segments = self._format_ai_response(raw_message_for_log) # Use raw message for formatting
-                
-                # This part needs to handle a list of segments
-                if isinstance(formatted_content_or_segments, list):
-                    for segment in formatted_content_or_segments:
-                        if segment['type'] == 'table':
-                            headers = segment.get('headers', [])
-                            rows = segment.get('rows', [])
-                            if headers: # Only proceed if there's actual table data
-                                table_frame = ttk.Frame(self.conversation_history)
-                                column_ids = [f"col_{i}" for i, _ in enumerate(headers)]
-                                tree = ttk.Treeview(table_frame, columns=column_ids, show="headings", height=len(rows) if rows else 1)
-                                for i, header_text in enumerate(headers):
-                                    tree.heading(column_ids[i], text=header_text.strip(), anchor=tk.W)
-                                    tree.column(column_ids[i], anchor=tk.W, width=100, stretch=tk.YES)
-                                for row_data in rows:
-                                    processed_row = []
-                                    for cell_idx, cell in enumerate(row_data):
-                                        if cell_idx < len(column_ids):
-                                            cell_text = str(cell).replace('\n', ' ').replace('<br>', ' ')
-                                            processed_row.append(cell_text)
-                                    tree.insert("", tk.END, values=processed_row)
-                                tree.pack(side=tk.LEFT, fill=tk.X, expand=True)
-                                self.conversation_history.insert(tk.END, '\n', tag_to_apply)
-                                self.conversation_history.window_create(tk.END, window=table_frame)
-                                self.conversation_history.insert(tk.END, '\n', tag_to_apply)
-                            else: # Empty table or malformed
-                                self.conversation_history.insert(tk.END, "AI Table (empty or malformed)\n", tag_to_apply)
-                        elif segment['type'] == 'text':
-                            self.conversation_history.insert(tk.END, segment['content'] + "\n", tag_to_apply)
-                elif isinstance(formatted_content_or_segments, dict) and formatted_content_or_segments.get('type') == 'table':
-                    # This case handles the old behavior where _format_ai_response might directly return one table
-                    # This should ideally be deprecated by the new list-based approach
-                    headers = formatted_content_or_segments.get('headers', [])
-                    rows = formatted_content_or_segments.get('rows', [])
-                    if headers: 
-                        table_frame = ttk.Frame(self.conversation_history)
-                        column_ids = [f"col_{i}" for i, _ in enumerate(headers)]
-                        tree = ttk.Treeview(table_frame, columns=column_ids, show="headings", height=len(rows) if rows else 1)
-                        for i, header_text in enumerate(headers):
-                            tree.heading(column_ids[i], text=header_text.strip(), anchor=tk.W)
-                            tree.column(column_ids[i], anchor=tk.W, width=100, stretch=tk.YES)
-                        for row_data in rows:
-                            processed_row = []
-                            for cell_idx, cell in enumerate(row_data):
-                                if cell_idx < len(column_ids):
-                                    cell_text = str(cell).replace('\n', ' ').replace('<br>', ' ')
-                                    processed_row.append(cell_text)
-                            tree.insert("", tk.END, values=processed_row)
-                        tree.pack(side=tk.LEFT, fill=tk.X, expand=True)
-                        self.conversation_history.insert(tk.END, '\n', tag_to_apply)
-                        self.conversation_history.window_create(tk.END, window=table_frame)
-                        self.conversation_history.insert(tk.END, '\n', tag_to_apply)
-                    else:
-                        self.conversation_history.insert(tk.END, "AI Table (empty or malformed)\n", tag_to_apply)
-                else: # It's formatted text (string) - old fallback
-                    self.conversation_history.insert(tk.END, str(formatted_content_or_segments) + "\n", tag_to_apply)
+                # Parsing and redundancy scoring run on the formatter thread; only the Tk rendering happens on the main thread
+                content = self._format_executor.submit(self._format_ai_response_cached, raw_message_for_log)
             else: # User, system, error messages
-                display_message = raw_message_for_log
-                self.conversation_history.insert(tk.END, display_message + "\n", tag_to_apply)
+                content = raw_message_for_log
+            self._display_queue.append((content, tag_to_apply, raw_message_for_log))
+            if self._display_poll_id is None: # Messages logged in the same Tk callback are rendered together once it returns
+                self._display_poll_id = self.root.after_idle(self._on_display_poll)
+
+        self.conversation_log.append({'role': role, 'content': raw_message_for_log})
+        # Keep the flags derived from the log current so callers don't rescan it
+        if not (role == "system" and raw_message_for_log.startswith("System: Welcome!")): self._has_non_welcome_log = True
+        if self.AI_CONFIGURED_MESSAGE in raw_message_for_log: self._ai_configured_logged = True
+
+    def _drain_display_queue(self):
+        """
+        Renders queued history entries in order, scheduled via root.after_idle by update_conversation_history.
+        An AI entry whose formatting is still running blocks the entries behind it, and the queue is polled again via root.after.
+        """
+        rendered_any = False
+        plain_inserts = [] # text, tag, text, tag, ... of consecutive plain entries, inserted with one Text.insert call
+        while self._display_queue:
+            content, tag_to_apply, raw_message = self._display_queue[0]
+            if isinstance(content, Future) and not content.done():
+                if self._display_poll_id is None:
+                    self._display_poll_id = self.root.after(self.DISPLAY_POLL_INTERVAL_MS, self._on_display_poll)
+                break
+            self._display_queue.popleft()
 
+            if not rendered_any:
+                self.conversation_history.config(state=tk.NORMAL)
+                rendered_any = True
+            if isinstance(content, Future):
+                if plain_inserts: self.conversation_history.insert(tk.END, *plain_inserts); plain_inserts = []
+                try:
+                    segments = content.result()
+                except Exception as e:
+                    logger.debug("Error formatting AI response: %s", e)
+                    segments = raw_message
+                self._render_ai_segments(segments, tag_to_apply)
+            else:
+                plain_inserts += (content + "\n", tag_to_apply)
+
+        if plain_inserts: self.conversation_history.insert(tk.END, *plain_inserts)
+        if rendered_any:
+            self._trim_conversation_display()
             self.conversation_history.see(tk.END)
             self.conversation_history.config(state=tk.DISABLED)
-        
-        self.conversation_log.append({'role': role, 'content': raw_message_for_log})
+
+    def _trim_conversation_display(self):
+        """Deletes the history lines beyond HISTORY_DISPLAY_MAX_LINES (oldest first); tables embedded in them return to the pool."""
+        widget = self.conversation_history
+        excess_lines = int(widget.index("end-1c").split(".")[0]) - self.HISTORY_DISPLAY_MAX_LINES
+        if excess_lines <= 0:
+            return
+        cut_index = f"{excess_lines + 1}.0"
+        trimmed_frames = {str(window_name) for _, window_name, _ in widget.dump("1.0", cut_index, window=True)}
+        widget.delete("1.0", cut_index) # Only unmaps embedded table frames, as in _clear_conversation_display
+        if not trimmed_frames:
+            return
+        tables_in_use = []
+        for table_widgets in self._history_tables_in_use:
+            if str(table_widgets[0]) in trimmed_frames:
+                tree = table_widgets[1]
+                tree.delete(*tree.get_children())
+                self._history_table_pool.append(table_widgets)
+            else:
+                tables_in_use.append(table_widgets)
+        self._history_tables_in_use = tables_in_use
+
+    def _on_display_poll(self):
+        self._display_poll_id = None
+        self._drain_display_queue()
+
+    def _clear_conversation_display(self):
+        """Empties the history widget and drops queued entries (pending AI formatting results are discarded)."""
+        if self._display_poll_id is not None:
+            self.root.after_cancel(self._display_poll_id)
+            self._display_poll_id = None
+        for content, _, _ in self._display_queue:
+            if isinstance(content, Future): content.cancel()
+        self._display_queue.clear()
+        self._stream_preview_pending = []; self._stream_preview_started = False
+        if hasattr(self, 'conversation_history'):
+            self.conversation_history.config(state=tk.NORMAL)
+            self.conversation_history.delete(1.0, tk.END) # Only unmaps embedded table frames, so they can be reused
+            self.conversation_history.config(state=tk.DISABLED)
+        for table_widgets in self._history_tables_in_use:
+            tree = table_widgets[1]
+            tree.delete(*tree.get_children())
+        self._history_table_pool.extend(self._history_tables_in_use)
+        self._history_tables_in_use.clear()
+
+    def _render_ai_segments(self, segments, tag_to_apply):
+        """Inserts formatted AI response segments (text and tables) into the history widget. Must run on the Tk thread."""
+        if isinstance(segments, ParsedTable):
+            # Old behavior where _format_ai_response returned one table directly
+            segments = [segments]
+        if isinstance(segments, list):
+            for segment in segments:
+                if isinstance(segment, ParsedTable):
+                    self._render_table_segment(segment.headers, segment.rows, tag_to_apply)
+                elif isinstance(segment, TextSegment):
+                    self.conversation_history.insert(tk.END, segment.content + "\n", tag_to_apply)
+        else: # It's formatted text (string) - old fallback
+            self.conversation_history.insert(tk.END, str(segments) + "\n", tag_to_apply)
+
+    def _render_table_segment(self, headers, rows, tag_to_apply):
+        """Embeds one parsed table as a Treeview in the history widget."""
+        if not headers: # Empty table or malformed
+            self.conversation_history.insert(tk.END, "AI Table (empty or malformed)\n", tag_to_apply)
+            return
+        column_ids = tuple(f"col_{i}" for i in range(len(headers)))
+        height = len(rows) if rows else 1
+        while self._history_table_pool and not self._history_table_pool[-1][0].winfo_exists():
+            self._history_table_pool.pop() # Destroyed elsewhere; not reusable
+        if self._history_table_pool:
+            table_widgets = self._history_table_pool.pop()
+            table_frame, tree, pooled_column_ids = table_widgets
+            configure_columns = pooled_column_ids != column_ids
+            if configure_columns:
+                tree.configure(columns=column_ids, height=height)
+                table_widgets[2] = column_ids
+            else:
+                tree.configure(height=height)
+        else:
+            table_frame = ttk.Frame(self.conversation_history)
+            tree = ttk.Treeview(table_frame, columns=column_ids, show="headings", height=height)
+            tree.pack(side=tk.LEFT, fill=tk.X, expand=True)
+            table_widgets = [table_frame, tree, column_ids]
+            configure_columns = True
+        self._history_tables_in_use.append(table_widgets)
+        for column_id, header_text in zip(column_ids, headers):
+            tree.heading(column_id, text=header_text.strip(), anchor=tk.W)
+            if configure_columns: tree.column(column_id, anchor=tk.W, width=100, stretch=tk.YES)
+        column_count = len(column_ids)
+        for row_data in rows:
+            tree.insert("", tk.END, values=[_CELL_DISPLAY_BREAK_RE.sub(' ', str(cell)) for cell in row_data[:column_count]])
+        self.conversation_history.insert(tk.END, '\n', tag_to_apply)
+        self.conversation_history.window_create(tk.END, window=table_frame)
+        self.conversation_history.insert(tk.END, '\n', tag_to_apply)
 
     def _update_ui_for_ai_status(self, api_key_configured=None, model_initialized=None):
         if not hasattr(self, 'send_button'): return
@@ -1011,24 +1463,31 @@ class ComponentComparatorAI:
             self.model_combobox.config(state="readonly")
 
     def _configure_ai(self):
+        """Picks up GOOGLE_API_KEY; the SDK itself is configured with it when the next model is created (_configured_genai)."""
         try:
             api_key = os.environ.get("GOOGLE_API_KEY")
-            if not api_key: print("DEBUG: GOOGLE_API_KEY not found for _configure_ai."); self.api_key_configured = False
-            else: genai.configure(api_key=api_key); self.api_key_configured = True
+            if not api_key: logger.debug("GOOGLE_API_KEY not found for _configure_ai."); self.api_key_configured = False
+            else: self._api_key = api_key; self.api_key_configured = True
         except Exception as e: self.update_conversation_history(f"System: Error configuring AI SDK: {e}", role="error"); self.api_key_configured = False
         finally: self._update_ui_for_ai_status(api_key_configured=self.api_key_configured, model_initialized=(self.model is not None))
 
+    def _configured_genai(self):
+        """Returns google.generativeai, configured with the API key picked up by _configure_ai."""
+        import google.generativeai as genai  # Lazy, see _preload_genai
+        if self._api_key != self._configured_api_key: # Same key (e.g. after Clear All): keep the SDK's clients and their open gRPC channel
+            genai.configure(api_key=self._api_key); self._configured_api_key = self._api_key
+        return genai
+
     def _on_model_selected(self, event=None):
-        if event: print(f"DEBUG: _on_model_selected. Event: {event.type}, Widget: {event.widget}")
-        else: print(f"DEBUG: _on_model_selected programmatically.")
-        selected_model_name = self.model_combobox.get(); print(f"DEBUG: Combobox get(): '{selected_model_name}'")
+        if event: logger.debug("_on_model_selected. Event: %s, Widget: %s", event.type, event.widget)
+        else: logger.debug("_on_model_selected programmatically.")
+        selected_model_name = self.model_combobox.get(); logger.debug("Combobox get(): '%s'", selected_model_name)
         if selected_model_name == self.placeholder_text:
             self.update_conversation_history("System: Select a valid AI model.", role="system"); self._update_ui_for_ai_status(model_initialized=False); return
         previous_model_name = self.model.model_name if self.model else None
-        is_diff_model = self.model and self.model.model_name != selected_model_name
+        is_diff_model = self.model and previous_model_name != selected_model_name
 
-        is_first_select_with_history = not self.model and self.conversation_log and \
-            any(not (log.get('role') == 'system' and log.get('content', '').startswith("System: Welcome!")) for log in self.conversation_log)
+        is_first_select_with_history = not self.model and self._has_non_welcome_log
 
         if is_diff_model or is_first_select_with_history:
             log_msg = f"System: Changing model";
@@ -1053,7 +1512,7 @@ class ComponentComparatorAI:
         if model_name == self.placeholder_text:
             self.update_conversation_history("System: Select valid model.", role="system"); self.model=None; self.chat_session=None; self._update_ui_for_ai_status(model_initialized=False); return False
         self.update_conversation_history(f"System: _initialize_model ({source_log}). Target: '{model_name}'", role="system")
-        if not model_name or model_name not in self.model_options_list:
+        if not model_name or model_name not in _MODEL_OPTION_NAMES:
             self.update_conversation_history(f"System: Invalid model ('{model_name}'). Aborted.", role="error"); self.model=None; self.chat_session=None; self._update_ui_for_ai_status(model_initialized=False); return False
         if self.model and self.model.model_name == model_name and self.api_key_configured:
             self.update_conversation_history(f"System: Model '{model_name}' already active.", role="system"); self._update_ui_for_ai_status(model_initialized=True); return True
@@ -1061,22 +1520,91 @@ class ComponentComparatorAI:
             self.update_conversation_history("System: Cannot init model - API key not set.", role="error"); self.model=None; self.chat_session=None; self._update_ui_for_ai_status(model_initialized=False); return False
         self.update_conversation_history(f"System: Initializing model: {model_name}...", role="system")
         try:
-            if not any(isinstance(log, dict) and "Generative AI configured successfully." in log.get('content', '') for log in self.conversation_log):
-                self.update_conversation_history("System: Generative AI configured successfully.", role="system")
-            self.model = genai.GenerativeModel(model_name); self.chat_session = None
+            if not self._ai_configured_logged:
+                self.update_conversation_history(f"System: {self.AI_CONFIGURED_MESSAGE}", role="system")
+            self.model = self._configured_genai().GenerativeModel(model_name); self.chat_session = None
             self.update_conversation_history(f"System: Successfully initialized model: {model_name}", role="system"); self._update_ui_for_ai_status(model_initialized=True); return True
         except Exception as e: self.model=None; self.chat_session=None; self.update_conversation_history(f"System: Error initializing model {model_name}: {e}", role="error"); self._update_ui_for_ai_status(model_initialized=False); return False
 
     def get_selected_model_name(self): return self.model_var.get()
-    def _add_to_ai_history(self,role:str,text_content:str): self.ai_history.append({'role':role,'parts':[text_content]}); print(f"DEBUG: AI history add: {role}, '{text_content[:50]}...'")
-    def _convert_log_to_gemini_history(self): return [e for e in self.ai_history if e['role'] in ('user','model')]
+    def _add_to_ai_history(self,role:str,text_content:str):
+        entry = {'role':role,'parts':[text_content]}; self.ai_history.append(entry)
+        if self._gemini_history_cache is not None and role in ('user','model'): self._gemini_history_cache.append(entry) # Keep the cached list current instead of rebuilding it
+        logger.debug("AI history add: %s, '%.50s...'", role, text_content)
+    def _translation_instruction(self) -> str:
+        """Prompt text asking for the response in the language selected by the 'Translate to Chinese' checkbox."""
+        return self.RESPONSE_IN_CHINESE_INSTRUCTION if self.translate_to_chinese_var.get() else self.RESPONSE_IN_ENGLISH_INSTRUCTION
+
+    def _start_background_task(self, work, on_done) -> bool:
+        """
+        Runs work() on a worker thread and then calls on_done(result, error) on the Tk thread.
+        Only one task runs at a time; returns False (starting nothing) while another is in flight.
+        """
+        if self._background_task_busy(): return False
+        self._background_task_running = True
+        generation = self._background_generation
+
+        def run():
+            self._worker_context.generation = generation
+            try: result, error = work(), None
+            except Exception as e: result, error = None, e
+            self._background_results.put((generation, on_done, (result, error), True))
+
+        # A daemon thread rather than an executor worker: closing the window must not wait for a request in flight
+        threading.Thread(target=run, daemon=True).start()
+        if self._background_poll_id is None:
+            self._background_poll_id = self.root.after(self.DISPLAY_POLL_INTERVAL_MS, self._poll_background_results)
+        return True
+
+    def _background_task_busy(self) -> bool:
+        """Returns True (telling the user to wait) while a background task is in flight."""
+        if self._background_task_running:
+            self.update_conversation_history("System: Another AI request is still running. Please wait for it to finish.", role="system")
+        return self._background_task_running
+
+    def _poll_background_results(self):
+        self._background_poll_id = None
+        while True:
+            try: generation, callback, args, is_final = self._background_results.get_nowait()
+            except queue.Empty: break
+            if is_final: self._background_task_running = False
+            if generation == self._background_generation: callback(*args)
+            elif is_final: self._update_ui_for_ai_status() # Stale result dropped; re-enable the inputs it disabled
+        if self._background_task_running and self._background_poll_id is None:
+            self._background_poll_id = self.root.after(self.DISPLAY_POLL_INTERVAL_MS, self._poll_background_results)
+
+    def _reset_conversation_log(self):
+        """Empties conversation_log and ai_history together with the flags derived from the log."""
+        self.conversation_log = deque(maxlen=self.CONVERSATION_LOG_MAX_ENTRIES); self.ai_history = []; self._gemini_history_cache = None
+        self._background_generation += 1 # Results of a still-running background task belong to the old conversation
+        self._format_ai_response_cached.cache_clear()
+        self._has_non_welcome_log = False # Log holds something besides the system welcome message
+        self._ai_configured_logged = False # AI_CONFIGURED_MESSAGE has been logged
+        self._detailed_comparison_memo = None # (inputs, response text) of the last detailed comparison in this conversation
+
+    def _convert_log_to_gemini_history(self):
+        """Returns the user/model turns of ai_history; the list is built once and then extended by _add_to_ai_history."""
+        if self._gemini_history_cache is None:
+            self._gemini_history_cache = [e for e in self.ai_history if e['role'] in ('user','model')]
+        return self._gemini_history_cache
 
     def send_user_query(self):
+        user_text = self.user_input_entry.get().strip()
+        if not user_text and not self.pending_user_image_path: # Nothing to send: skip model setup and widget state changes
+            self.update_conversation_history("System: Cannot send empty message.", role="system"); return
+
         if not self.model or not self.api_key_configured:
             if not self._initialize_model(): return
         if not self.model: self.update_conversation_history("System: AI Model N/A.", role="error"); return
+        if self._background_task_busy(): return # Keep the typed text until the running request is done
+
+        user_image = None
+        if self.pending_user_image_path:
+            try: user_image = _open_user_image(self.pending_user_image_path)
+            except Exception as e: # Moved or changed since it was attached; keep the typed text so the user can retry
+                self.update_conversation_history(f"System: Error reading attached image {self.pending_user_image_path}: {e}. Please attach it again.", role="error")
+                self.pending_user_image_path = None; return
 
-        user_text = self.user_input_entry.get().strip()
         # self.update_conversation_history is called after constructing prompt_parts_for_ai
         self.user_input_entry.delete(0, tk.END)
 
@@ -1084,22 +1612,20 @@ class ComponentComparatorAI:
         image_sent_this_turn = False
         log_message_for_user_turn = user_text
 
-        if self.pending_user_image_pil:
+        if user_image is not None:
             if user_text: # Text and image
                 prompt_parts_for_ai.append(user_text)
-                prompt_parts_for_ai.append(self.pending_user_image_pil)
+                prompt_parts_for_ai.append(user_image)
             else: # Image only
-                prompt_parts_for_ai.append(self.pending_user_image_pil)
+                prompt_parts_for_ai.append(user_image)
 
             image_filename = os.path.basename(self.pending_user_image_path)
             self.update_conversation_history(f"User: {user_text} [Image: {image_filename}]", role="user")
             log_message_for_user_turn = f"{user_text} [Image: {image_filename}]"
             image_sent_this_turn = True
-        elif user_text: # Text only
+        else: # Text only
             prompt_parts_for_ai.append(user_text)
             self.update_conversation_history(f"User: {user_text}", role="user")
-        else:
-            self.update_conversation_history("System: Cannot send empty message.", role="system"); return
 
         active_model_name = self.model.model_name
         try:
@@ -1113,59 +1639,91 @@ class ComponentComparatorAI:
 
             self.update_conversation_history(f"System: Sending to AI ({active_model_name})...", role="system")
 
-            datasheet_sourcing_instruction_text = (
-                "IMPORTANT INSTRUCTIONS FOR AI RESPONSE:\n"
-                "- Base your answers primarily on the information extracted from the provided component datasheets "
-                "(text, images, and context from previous conversation turns, including component type and MFG P/N if known).\n"
-                "- If the datasheets or prior conversation context lack specific information to answer your query, you may use your general knowledge.\n"
-                "- If you use general knowledge, you MUST explicitly state that the information was not found in the provided datasheets/context "
-                "and that your answer is based on general understanding.\n\n"
-            )
-
-            # Construct the prompt with sourcing instruction first, then user's actual content parts
-            prompt_with_sourcing_instruction = [datasheet_sourcing_instruction_text] + prompt_parts_for_ai
-
-            final_prompt_parts_for_sending = list(prompt_with_sourcing_instruction) # Use a copy
-
-            if hasattr(self, 'root'): self.root.update_idletasks()
-            if self.translate_to_chinese_var.get():
-                translation_instruction = " Please provide your entire response in Chinese."
-            else:
-                translation_instruction = " Please provide your entire response in English."
-
-            appended_to_text = False
-            for i in range(len(final_prompt_parts_for_sending) - 1, -1, -1):
-                if isinstance(final_prompt_parts_for_sending[i], str):
-                    final_prompt_parts_for_sending[i] += translation_instruction
-                    appended_to_text = True; break
-            if not appended_to_text: final_prompt_parts_for_sending.append(translation_instruction)
+            # Sourcing and response-language instructions first, then the user's actual content parts
+            final_prompt_parts_for_sending = [self.CHAT_SOURCING_INSTRUCTION + self._translation_instruction(), *prompt_parts_for_ai]
 
-            response = self.chat_session.send_message(final_prompt_parts_for_sending)
+            # The reply is streamed in the background; _on_chat_response re-enables the inputs
+            chat_session = self.chat_session
+            self._start_background_task(
+                lambda: self._stream_chat_message(chat_session, final_prompt_parts_for_sending, active_model_name),
+                lambda response, error: self._on_chat_response(response, error, active_model_name, image_sent_this_turn))
+        except Exception as e:
+            self._on_chat_response(None, e, active_model_name, image_sent_this_turn)
+
+    def _stream_chat_message(self, chat_session, prompt_parts, active_model_name):
+        """Background half of send_user_query: sends prompt_parts with stream=True and shows each chunk as it arrives."""
+        response = chat_session.send_message(prompt_parts, stream=True)
+        try: self._forward_stream_chunks(response, active_model_name)
+        except Exception:
+            try: chat_session.rewind() # Drop the broken turn so the next message doesn't fail on the chat history
+            except Exception as e: logger.debug("Could not rewind chat after a failed stream: %s", e)
+            raise
+        return response
+
+    def _forward_stream_chunks(self, response, active_model_name):
+        """Worker side of the streaming preview: reads a stream=True response to the end, passing each text chunk to _show_streamed_chunk."""
+        generation = self._worker_context.generation
+        for chunk in response:
+            try: chunk_text = chunk.text
+            except ValueError: continue # Chunk without text parts (e.g. only the finish reason)
+            if chunk_text: self._background_results.put((generation, self._show_streamed_chunk, (active_model_name, chunk_text), False))
+
+    def _show_streamed_chunk(self, active_model_name, chunk_text):
+        """
+        Appends a streamed chunk to the end of the history as plain text tagged "stream_preview".
+        _on_chat_response / _on_ai_response replace the preview with the complete, formatted reply.
+        """
+        if not hasattr(self, 'conversation_history'): return
+        self._stream_preview_pending.append(chunk_text)
+        self._drain_display_queue()
+        if self._display_queue: return # An earlier entry is still being formatted; the preview goes below it
+        widget = self.conversation_history
+        widget.config(state=tk.NORMAL)
+        if not self._stream_preview_started:
+            widget.insert(tk.END, f"AI ({active_model_name}): ", ("ai_message", "stream_preview"))
+            self._stream_preview_started = True
+        widget.insert(tk.END, "".join(self._stream_preview_pending), ("ai_message", "stream_preview"))
+        self._stream_preview_pending = []
+        widget.see(tk.END)
+        widget.config(state=tk.DISABLED)
+
+    def _remove_stream_preview(self):
+        """Deletes the text shown by _show_streamed_chunk."""
+        self._stream_preview_pending = []
+        if not self._stream_preview_started: return
+        self._stream_preview_started = False
+        widget = self.conversation_history
+        preview_ranges = widget.tag_ranges("stream_preview")
+        widget.config(state=tk.NORMAL)
+        for range_start, range_end in reversed(list(zip(preview_ranges[::2], preview_ranges[1::2]))):
+            widget.delete(range_start, range_end)
+        widget.config(state=tk.DISABLED)
+
+    def _on_chat_response(self, response, error, active_model_name, image_sent_this_turn):
+        """Tk-thread half of send_user_query: logs the chat reply (or error) in place of the streamed preview and re-enables the inputs."""
+        self._remove_stream_preview()
+        try:
+            if error is not None: raise error
             self._add_to_ai_history('model', response.text)
             self.update_conversation_history(f"AI ({active_model_name}): {response.text}", role="ai")
 
             if image_sent_this_turn:
-                self.pending_user_image_path = None; self.pending_user_image_pil = None
+                self.pending_user_image_path = None
         except Exception as e:
-            err_msg=f"System: Error with AI ({active_model_name}): {e}"; self.update_conversation_history(err_msg,role="error"); print(f"DEBUG: {err_msg}")
-            if isinstance(e,(google_exceptions.PermissionDenied,google_exceptions.Unauthenticated)): self.api_key_configured=False
-            if isinstance(e,(google_exceptions.InvalidArgument,ValueError,BlockedPromptException,StopCandidateException,google_exceptions.NotFound,google_exceptions.PermissionDenied)):
-                self.update_conversation_history(f"System: Resetting model ({active_model_name}) due to error.",role="system"); self.model=None; self.chat_session=None; self.ai_history=[]
+            err_msg=f"System: Error with AI ({active_model_name}): {e}"; self.update_conversation_history(err_msg,role="error"); logger.debug("%s", err_msg)
+            auth_errors, model_reset_errors = _ai_error_types()
+            if isinstance(e,auth_errors): self.api_key_configured=False
+            if isinstance(e,model_reset_errors):
+                self.update_conversation_history(f"System: Resetting model ({active_model_name}) due to error.",role="system"); self.model=None; self.chat_session=None; self.ai_history=[]; self._gemini_history_cache=None
         finally: self._update_ui_for_ai_status()
 
     def download_history(self):
-        # Ensure necessary imports are at the top of main.py:
-        # import os
-        # import docx
-        # from tkinter import filedialog # Already imported usually
-        # from docx.shared import RGBColor # Should be at top of main.py by now
-        # import traceback # Should be at top of main.py by now
-
         if not self.conversation_log:
             self.update_conversation_history("System: History empty. Nothing to download.", role="system")
             return
 
         try:
+            from tkinter import filedialog  # Lazy, as in on_upload_image
             filepath = filedialog.asksaveasfilename(
                 defaultextension=".docx",
                 filetypes=[("Word Document", "*.docx"), ("All Files", "*.*")],
@@ -1180,8 +1738,21 @@ class ComponentComparatorAI:
             return
 
         try:
+            # python-docx (and lxml behind it) is only needed here; importing it lazily keeps it off the startup path
+            import docx
+            from docx.oxml import OxmlElement
+            from docx.shared import RGBColor
+            from docx.text.paragraph import Paragraph
             doc = docx.Document()
-            # RGBColor should be imported via `from docx.shared import RGBColor` at module level
+            # doc.add_paragraph() finds the trailing sectPr by scanning every body element, which makes long logs quadratic;
+            # new paragraphs are put straight in front of it instead (tables are few and still use doc.add_table)
+            section_properties = doc.element.body.sectPr
+            def add_paragraph(text=""):
+                p_element = OxmlElement('w:p')
+                section_properties.addprevious(p_element)
+                paragraph = Paragraph(p_element, doc)
+                if text: paragraph.add_run(text)
+                return paragraph
 
             doc.add_heading("Component Comparator AI Chat History", level=1)
 
@@ -1199,27 +1770,24 @@ class ComponentComparatorAI:
             }
 
             if self.spec_sheet_1_path:
-                p = doc.add_paragraph()
+                p = add_paragraph()
                 # os.path.basename needs `import os` at module level
                 run = p.add_run(f"Spec Sheet 1: {os.path.basename(self.spec_sheet_1_path)}")
                 run.font.color.rgb = SYSTEM_COLOR
             if self.spec_sheet_2_path:
-                p = doc.add_paragraph()
+                p = add_paragraph()
                 run = p.add_run(f"Spec Sheet 2: {os.path.basename(self.spec_sheet_2_path)}")
                 run.font.color.rgb = SYSTEM_COLOR
 
             model_name_to_log = "N/A"
             if self.model and hasattr(self.model, 'model_name'):
                 model_name_to_log = self.model.model_name
-            p = doc.add_paragraph()
+            p = add_paragraph()
             run = p.add_run(f"AI Model (last used): {model_name_to_log}")
             run.font.color.rgb = SYSTEM_COLOR
-            doc.add_paragraph("-" * 20)
+            add_paragraph("-" * 20)
 
             for entry_data in self.conversation_log:
-                # CRUCIAL DEBUG LOGGING TO VERIFY THIS VERSION IS RUNNING:
-                # print(f"DEBUG download_history (v3): Processing entry_data of type: {type(entry_data)}, content snippet: '{str(entry_data)[:150]}...'")
-
                 entry_role = None
                 entry_content = None
 
@@ -1229,9 +1797,7 @@ class ComponentComparatorAI:
                 elif isinstance(entry_data, str):
                     entry_role = 'system'
                     entry_content = entry_data
-                    # REMOVED: print(f"DEBUG download_history (v3): Handled string entry: '{entry_data[:100]}...'. Assigned role '{entry_role}'.")
-                else:
-                    # REMOVED: print(f"DEBUG download_history (v3): Skipping unknown entry type in log: {type(entry_data)}")
+                else: # Unknown entry type
                     continue
 
                 if entry_content is None:
@@ -1245,64 +1811,73 @@ class ComponentComparatorAI:
                 if not entry_content.strip():
                     continue
 
-                segments = self._format_ai_response(entry_content)
+                segments = self._format_ai_response_cached(entry_content)
 
                 if segments:
                     for segment_idx, segment in enumerate(segments):
-                        segment_type = segment.get('type')
-
-                        if segment_type == 'table':
-                            headers = segment.get('headers', [])
-                            data_rows = segment.get('rows', [])
+                        if isinstance(segment, ParsedTable):
+                            headers = segment.headers
+                            data_rows = segment.rows
                             num_cols = len(headers)
 
                             if num_cols > 0 and data_rows:
-                                word_table = doc.add_table(rows=1, cols=num_cols)
+                                # All rows are created up front; add_row() per row re-reads the grid and copies column widths each time
+                                word_table = doc.add_table(rows=1 + len(data_rows), cols=num_cols)
+                                for word_row, row_values in zip(word_table.rows, [headers, *data_rows]):
+                                    for word_cell, cell_text_content in zip(word_row.cells, row_values):
+                                        cell_run = word_cell.paragraphs[0].add_run(str(cell_text_content))
+                                        cell_run.font.color.rgb = text_color
                                 word_table.style = 'TableGrid'
-                                for col_idx, header_text_val in enumerate(headers):
-                                    cell_run = word_table.cell(0, col_idx).paragraphs[0].add_run(str(header_text_val))
-                                    cell_run.font.color.rgb = text_color
-                                for data_row_list in data_rows:
-                                    row_cells = word_table.add_row().cells
-                                    for col_idx, cell_text_content in enumerate(data_row_list):
-                                        if col_idx < num_cols:
-                                            cell_run = row_cells[col_idx].paragraphs[0].add_run(str(cell_text_content))
-                                            cell_run.font.color.rgb = text_color
                                 if segment_idx < len(segments) - 1:
-                                    doc.add_paragraph('')
+                                    add_paragraph('')
                             elif num_cols > 0 and not data_rows:
-                                p = doc.add_paragraph()
+                                p = add_paragraph()
                                 run = p.add_run(f"[Table with headers: {', '.join(headers)} - No data rows]")
                                 run.font.color.rgb = text_color
                                 if segment_idx < len(segments) - 1:
-                                    doc.add_paragraph('')
+                                    add_paragraph('')
 
-                        elif segment_type == 'text':
-                            current_text_content = segment.get('content', '')
+                        elif isinstance(segment, TextSegment):
+                            current_text_content = segment.content
                             if current_text_content.strip():
-                                p = doc.add_paragraph()
+                                p = add_paragraph()
                                 run = p.add_run(current_text_content)
                                 run.font.color.rgb = text_color
                                 if segment_idx < len(segments) - 1:
-                                    doc.add_paragraph('')
+                                    add_paragraph('')
 
                 elif entry_content.strip():
-                    p = doc.add_paragraph()
+                    p = add_paragraph()
                     run = p.add_run(f"[Unprocessed Entry - Role: {entry_role}]: {entry_content}")
                     run.font.color.rgb = text_color
-                    # REMOVED: print(f"DEBUG: Download History (v3) - Entry was not processed into segments by _format_ai_response (Role: {entry_role}): {entry_content[:100]}...")
 
-            doc.save(filepath)
-            self.update_conversation_history(f"System: Conversation history downloaded to {filepath}", role="system")
+            # Serializing and zipping the document takes a while for long logs, so it runs off the Tk thread.
+            # Not a daemon thread: closing the window waits for the file to be written.
+            save = Future()
+            def run_save():
+                try: _save_docx_atomically(doc, filepath); save.set_result(None)
+                except Exception as e: save.set_exception(e)
+            threading.Thread(target=run_save, name="history-save").start()
+            self.root.after(self.DISPLAY_POLL_INTERVAL_MS, self._poll_history_save, save, filepath)
 
         except Exception as e:
-            # KEPT: This is important error logging
-            print(f"DEBUG: Error saving .docx history (v3): {e}\n{traceback.format_exc()}")
-            error_message = f"System: Error during history download: {e}"
-            self.update_conversation_history(error_message, role="error")
+            self._report_history_save_error(e)
+
+    def _poll_history_save(self, save, filepath):
+        """Reports the outcome of the document save started by download_history once it has finished."""
+        if not save.done(): self.root.after(self.DISPLAY_POLL_INTERVAL_MS, self._poll_history_save, save, filepath); return
+        error = save.exception()
+        if error is not None: self._report_history_save_error(error); return
+        self.update_conversation_history(f"System: Conversation history downloaded to {filepath}", role="system")
+
+    def _report_history_save_error(self, e):
+        # KEPT: This is important error logging
+        logger.error("Error saving .docx history (v3): %s", e, exc_info=e)
+        error_message = f"System: Error during history download: {e}"
+        self.update_conversation_history(error_message, role="error")
 
     def clear_all(self, clear_files=True):
-        print(f"DEBUG: clear_all called with clear_files={clear_files}")
+        logger.debug("clear_all called with clear_files=%s", clear_files)
         if clear_files:
             self.spec_sheet_1_path=None; self.spec_sheet_1_text=None; self.spec_sheet_1_image_paths=[]
             self.spec_sheet_2_path=None; self.spec_sheet_2_text=None; self.spec_sheet_2_image_paths=[]
@@ -1311,18 +1886,28 @@ class ComponentComparatorAI:
             if hasattr(self,'mfg_pn_var_1'): self.mfg_pn_var_1.set("")
             if hasattr(self,'mfg_pn_var_2'): self.mfg_pn_var_2.set("")
             if hasattr(self,'model_combobox'): self.model_combobox.set(self.placeholder_text); self.model_combobox.state(["disabled"])
+            _decoded_prompt_images.clear() # Spec sheets are unloaded; drop their decoded images too
             if os.path.exists(self.temp_image_dir):
-                try: shutil.rmtree(self.temp_image_dir); print(f"DEBUG: Deleted temp dir: {self.temp_image_dir}")
-                except OSError as e: print(f"Error deleting temp dir {self.temp_image_dir}: {e}")
+                # Move the folder aside (one rename) and delete its contents on a daemon thread instead of blocking the UI
+                doomed_dir = f"{self.temp_image_dir}_deleting_{os.getpid()}_{next(self._image_dir_counter)}"
+                try:
+                    os.rename(self.temp_image_dir, doomed_dir)
+                    threading.Thread(target=shutil.rmtree, args=(doomed_dir,), kwargs={'ignore_errors': True}, name="temp-cleanup", daemon=True).start()
+                    logger.debug("Deleting temp dir in background: %s", doomed_dir)
+                except OSError: # Rename refused (e.g. a file still open on Windows): delete in place
+                    try: shutil.rmtree(self.temp_image_dir); logger.debug("Deleted temp dir: %s", self.temp_image_dir)
+                    except OSError as e: logger.warning("Error deleting temp dir %s: %s", self.temp_image_dir, e)
             self._create_temp_image_dir()
+            self._extracted_image_paths.clear() # Their files were in the deleted folder
 
         self.pending_user_image_path = None
-        self.pending_user_image_pil = None
 
-        if hasattr(self,'conversation_history'): self.conversation_history.config(state=tk.NORMAL); self.conversation_history.delete(1.0, tk.END)
+        self._clear_conversation_display()
+        self._stop_comparison_rows_insert() # Stop any in-progress chunked row insertion
         if hasattr(self,'comparison_treeview'):
-            for item in self.comparison_treeview.get_children(): self.comparison_treeview.delete(item)
-        self.conversation_log=[]; self.ai_history=[]
+            self.comparison_treeview.delete(*self.comparison_treeview.get_children())
+        self._reset_conversation_log()
+        self._discard_datasheet_cache() # After the generation bump, so a cache still being created is never stored (see _get_datasheet_cached_model)
         if clear_files: self.update_conversation_history("System: Welcome! Load PDFs to start.",role="system")
         if hasattr(self,'user_input_entry'): self.user_input_entry.delete(0,tk.END)
         self.model=None; self.chat_session=None
@@ -1334,47 +1919,70 @@ class ComponentComparatorAI:
              if hasattr(self,'model_combobox'): self.model_combobox.state(['disabled'])
         if hasattr(self, 'start_comparison_button'): self.start_comparison_button.config(state=tk.DISABLED)
         self._update_ui_for_ai_status(api_key_configured=self.api_key_configured,model_initialized=False)
-        print("DEBUG: Clear All finished.")
+        logger.debug("Clear All finished.")
 
     def extract_text_from_pdf(self, filepath):
-        if not filepath or not os.path.exists(filepath): self.update_conversation_history(f"System: PDF not found: {os.path.basename(filepath or 'Unknown')}", role="error"); return ""
+        file_name = os.path.basename(filepath or 'Unknown') # Used by every status message below
+        if not filepath or not os.path.exists(filepath): self.update_conversation_history(f"System: PDF not found: {file_name}", role="error"); return ""
         try:
-            self.update_conversation_history(f"System: Extracting text from {os.path.basename(filepath)}...", role="system")
-            with fitz.open(filepath) as doc: text = "".join(page.get_text() for page in doc)
-            self.update_conversation_history(f"System: Text extraction OK: {os.path.basename(filepath)}.", role="system"); return text
-        except Exception as e: self.update_conversation_history(f"System: Error extracting text from {os.path.basename(filepath)}: {e}", role="error"); return ""
+            cache_path = _pdf_text_cache_path(filepath)
+            try:
+                with open(cache_path, encoding="utf-8", newline="") as f: text = f.read()
+            except (OSError, UnicodeError): text = "" # Not cached yet (or unreadable): extract below
+            if text:
+                try: os.utime(cache_path) # Mark as recently used for _prune_pdf_text_cache
+                except OSError: pass
+                self.update_conversation_history(f"System: Text extraction OK (cached): {file_name}.", role="system"); return text
+            self.update_conversation_history(f"System: Extracting text from {file_name}...", role="system")
+            import fitz  # PyMuPDF is only needed once a spec sheet is processed; importing it lazily keeps it off the startup path
+            with fitz.open(filepath) as doc: text = "".join([page.get_text("text") for page in doc]) # Plain-text mode: no block/dict/HTML layout output
+            if text: _store_pdf_text_cache(cache_path, text)
+            self.update_conversation_history(f"System: Text extraction OK: {file_name}.", role="system"); return text
+        except Exception as e: self.update_conversation_history(f"System: Error extracting text from {file_name}: {e}", role="error"); return ""
 
     def extract_images_from_pdf(self, filepath, output_folder):
-        if not filepath or not os.path.exists(filepath): self.update_conversation_history(f"System: PDF not found: {os.path.basename(filepath or 'Unknown')}", role="error"); return []
+        file_name = os.path.basename(filepath or 'Unknown') # Used by every status message below
+        if not filepath or not os.path.exists(filepath): self.update_conversation_history(f"System: PDF not found: {file_name}", role="error"); return []
         paths = []
         try:
-            self.update_conversation_history(f"System: Extracting images from {os.path.basename(filepath)}...", role="system")
+            self.update_conversation_history(f"System: Extracting images from {file_name}...", role="system")
             if not os.path.exists(output_folder): os.makedirs(output_folder)
-            with fitz.open(filepath) as doc:
+            # PyMuPDF documents must not be shared between threads, so images are extracted here and only the file writes run on the pool
+            writes = [] # (path, Future of the write), in page/image order
+            seen_xrefs = set(); repeated_images = 0 # Logos and headers reuse one image object on every page; it is kept once
+            import fitz  # Lazy, as in extract_text_from_pdf
+            with fitz.open(filepath) as doc, ThreadPoolExecutor(max_workers=_IMAGE_WRITE_WORKERS) as write_pool:
                 for i, page in enumerate(doc):
                     for j, img_info in enumerate(page.get_images(full=True)):
                         xref = img_info[0]
+                        if xref in seen_xrefs: repeated_images += 1; continue
+                        seen_xrefs.add(xref)
                         try: base = doc.extract_image(xref)
                         except Exception as e: self.update_conversation_history(f"System: Error extracting img xref {xref} pg {i+1}. Skip. Err: {e}", role="error"); continue
                         img_bytes, ext = base["image"], base["ext"]
                         path = os.path.join(output_folder, f"pg{i+1}_img{j+1}.{ext}")
-                        try:
-                            with open(path, "wb") as f: f.write(img_bytes)
-                            paths.append(path)
-                        except IOError as e: self.update_conversation_history(f"System: IOError saving image {path}. Error: {e}", role="error")
-            msg = f"System: Extracted {len(paths)} images from {os.path.basename(filepath)}." if paths else f"System: No images found in {os.path.basename(filepath)}."
+                        writes.append((path, write_pool.submit(_write_file_bytes, path, img_bytes)))
+            for path, write in writes:
+                try:
+                    write.result()
+                    paths.append(path)
+                except IOError as e: self.update_conversation_history(f"System: IOError saving image {path}. Error: {e}", role="error")
+            msg = f"System: Extracted {len(paths)} images from {file_name}." if paths else f"System: No images found in {file_name}."
+            if repeated_images: msg = f"{msg[:-1]} ({repeated_images} repeated on other pages skipped)."
             self.update_conversation_history(msg, role="system"); return paths
-        except Exception as e: self.update_conversation_history(f"System: Error extracting images from {os.path.basename(filepath)}: {e}", role="error"); return []
+        except Exception as e: self.update_conversation_history(f"System: Error extracting images from {file_name}: {e}", role="error"); return []
 
     def check_and_process_spec_sheets(self):
         if not (self.spec_sheet_1_path and self.spec_sheet_2_path): return
         if not self.api_key_configured: self.update_conversation_history("System: API Key not configured.", role="error"); return
         if not self.model: self.update_conversation_history("System: AI Model not selected. Please select a model.", role="system"); return
+        if self._background_task_busy(): return # Keep the running analysis and its history
         self.update_conversation_history("System: Files and model active. Clearing old results...", role="system")
-        self.conversation_log = []; self.ai_history = []
-        if hasattr(self, 'conversation_history'): self.conversation_history.config(state=tk.NORMAL); self.conversation_history.delete(1.0, tk.END)
+        self._reset_conversation_log()
+        self._clear_conversation_display()
+        self._stop_comparison_rows_insert() # Stop any in-progress chunked row insertion
         if hasattr(self, 'comparison_treeview'):
-            for item in self.comparison_treeview.get_children(): self.comparison_treeview.delete(item)
+            self.comparison_treeview.delete(*self.comparison_treeview.get_children())
         if self.api_key_configured: self.update_conversation_history("System: AI Configured.", role="system")
         if self.model: self.update_conversation_history(f"System: Model '{self.model.model_name}' active.", role="system")
         self.process_spec_sheets()
@@ -1382,90 +1990,177 @@ class ComponentComparatorAI:
     def process_spec_sheets(self):
         if not self.model or not self.api_key_configured or not self.spec_sheet_1_path or not self.spec_sheet_2_path:
             self.update_conversation_history("System: Pre-reqs not met (files, API key, model).", role="error"); return
+        if self._background_task_busy(): return
         self.update_conversation_history("System: Starting initial analysis...", role="system")
-        self.spec_sheet_1_text = self.extract_text_from_pdf(self.spec_sheet_1_path)
-        if not self.spec_sheet_1_text: self.update_conversation_history(f"System: Halting. Text extract fail: {os.path.basename(self.spec_sheet_1_path)}.", role="error"); return
-        s1_f = os.path.join(self.temp_image_dir, f"{os.path.splitext(os.path.basename(self.spec_sheet_1_path))[0]}_imgs_{len(os.listdir(self.temp_image_dir))}")
-        self.spec_sheet_1_image_paths = self.extract_images_from_pdf(self.spec_sheet_1_path, s1_f)
-        self.spec_sheet_2_text = self.extract_text_from_pdf(self.spec_sheet_2_path)
-        if not self.spec_sheet_2_text: self.update_conversation_history(f"System: Halting. Text extract fail: {os.path.basename(self.spec_sheet_2_path)}.", role="error"); return
-        s2_f = os.path.join(self.temp_image_dir, f"{os.path.splitext(os.path.basename(self.spec_sheet_2_path))[0]}_imgs_{len(os.listdir(self.temp_image_dir))}")
-        self.spec_sheet_2_image_paths = self.extract_images_from_pdf(self.spec_sheet_2_path, s2_f)
-
-        initial_analysis_prompt_text = (
-            "You are an expert electronics component analyst. Analyze the following two component specification sheets.\n\n"
-            "**Instructions for AI:**\n"
-            "1. For Component 1 (described first), identify its specific component type.\n"
-            "2. For Component 2 (described second), identify its specific component type.\n"
-            "3. Assess if Component 1 and Component 2 are functionally similar (e.g., both are dual N-channel MOSFETs, or one is an LDO regulator and the other a switching regulator, or one is a TVS diode and the other a Zener diode). Your assessment should be based on their primary function.\n"
-            "4. For Component 1, find and extract the first complete Manufacturer Part Number (MFG P/N) listed in its 'Order Information' or equivalent section. If multiple are listed, provide only the first one. If none is explicitly found, state 'Not Found'.\n"
-            "5. For Component 2, find and extract the first complete Manufacturer Part Number (MFG P/N) listed in its 'Order Information' or equivalent section. If multiple are listed, provide only the first one. If none is explicitly found, state 'Not Found'.\n\n"
-            "**Output Format:**\n"
-            "Please provide your response *only* in the following structured format, using these exact labels:\n"
-            "Component1_Type: [Type for component 1]\n"
-            "Component2_Type: [Type for component 2]\n"
-            "Functionally_Similar: [Yes/No, brief explanation]\n"
-            "MFG_PN1: [MFG P/N for component 1 or 'Not Found']\n"
-            "MFG_PN2: [MFG P/N for component 2 or 'Not Found']\n\n"
-            "**Component 1 Data:**\n"
-            f"Text Content:\n{self.spec_sheet_1_text}\n\n"
-            "**Component 2 Data:**\n"
-            f"Text Content:\n{self.spec_sheet_2_text}\n"
-        )
+        # PDF extraction and the AI request run in the background so the window stays responsive
+        sheet_paths = (self.spec_sheet_1_path, self.spec_sheet_2_path)
+        self._start_background_task(lambda: self._extract_spec_sheets(sheet_paths), self._on_spec_sheets_extracted)
 
-        prompt_parts_for_genai = [initial_analysis_prompt_text]
-        # Add images for component 1
-        for img_path in self.spec_sheet_1_image_paths:
-            try: prompt_parts_for_genai.append(Image.open(img_path))
-            except Exception as e: self.update_conversation_history(f"System: Error loading image {img_path} for Comp 1. Skip. Err: {e}", role="error")
-        # Add images for component 2
+    def _extract_spec_sheets(self, sheet_paths):
+        """
+        Background part of process_spec_sheets: extracts the text and images of each sheet and opens the images.
+        Returns [(text, image_paths, images), ...]; stops after a sheet whose text extraction failed.
+        """
+        sheets = []
+        for path in sheet_paths:
+            text = self.extract_text_from_pdf(path)
+            file_name = os.path.basename(path)
+            if not text:
+                self.update_conversation_history(f"System: Halting. Text extract fail: {file_name}.", role="error")
+                sheets.append((text, None, [])); return sheets
+            try: pdf_key = _pdf_file_key(path)
+            except OSError: pdf_key = None
+            image_paths = self._extracted_image_paths.get(pdf_key)
+            if image_paths and all(map(os.path.exists, image_paths)): # Same unchanged PDF, images not cleared since
+                self.update_conversation_history(f"System: Reusing {len(image_paths)} images already extracted from {file_name}.", role="system")
+            else:
+                image_folder = os.path.join(self.temp_image_dir, f"{os.path.splitext(file_name)[0]}_imgs_{next(self._image_dir_counter)}")
+                image_paths = self.extract_images_from_pdf(path, image_folder)
+                if pdf_key is not None and image_paths: self._extracted_image_paths[pdf_key] = image_paths
+            sheets.append((text, image_paths, []))
+        for sheet_number, (_, image_paths, images) in enumerate(sheets, start=1):
+            for img_path in image_paths:
+                try:
+                    images.append(_load_prompt_image(img_path))
+                except Exception as e: self.update_conversation_history(f"System: Error loading image {img_path} for Comp {sheet_number}. Skip. Err: {e}", role="error")
+        return sheets
+
+    def _on_spec_sheets_extracted(self, sheets, error):
+        if error is not None:
+            self.update_conversation_history(f"System: Error processing spec sheets: {error}", role="error"); return
+        for sheet_number, (text, image_paths, _) in enumerate(sheets, start=1):
+            setattr(self, f"spec_sheet_{sheet_number}_text", text)
+            if image_paths is not None: setattr(self, f"spec_sheet_{sheet_number}_image_paths", image_paths)
+        if len(sheets) < 2 or sheets[-1][1] is None: return # Halted on a failed text extraction (already reported)
+
+        # Instructions, then images; send_to_ai puts the datasheet block (shared with the detailed comparison) in front
+        prompt_parts_for_genai = [self.INITIAL_ANALYSIS_INSTRUCTIONS]
+        prompt_parts_for_genai.extend(sheets[0][2]) # Images for component 1
         prompt_parts_for_genai.append("\n--- End of Component 1 Images, Start of Component 2 Images (if any) ---") # Separator for clarity if needed
-        for img_path in self.spec_sheet_2_image_paths:
-            try: prompt_parts_for_genai.append(Image.open(img_path))
-            except Exception as e: self.update_conversation_history(f"System: Error loading image {img_path} for Comp 2. Skip. Err: {e}", role="error")
+        prompt_parts_for_genai.extend(sheets[1][2]) # Images for component 2
 
         user_prompt_for_history_log = "User: Initial component type identification and MFG P/N extraction for spec sheets."
         self.send_to_ai(prompt_parts_for_genai, is_initial_analysis=True, user_prompt_for_history=user_prompt_for_history_log)
 
 
-    def send_to_ai(self, prompt_parts, is_initial_analysis=False, user_prompt_for_history=None):
-        if not self.model: self.update_conversation_history("System: AI model N/A.", role="error"); return None
-        active_model_name = self.model.model_name
-        raw_ai_response_text = ""
+    def send_to_ai(self, prompt_parts, is_initial_analysis=False, user_prompt_for_history=None, on_response=None):
+        """
+        Sends the datasheet block followed by prompt_parts with generate_content on a background thread, streaming the answer
+        into the history. The response is handled on the Tk thread, which then calls on_response(raw_ai_response_text).
+        Returns False if nothing was sent.
+        """
+        if not self.model: self.update_conversation_history("System: AI model N/A.", role="error"); return False
+        if self._background_task_busy(): return False # Checked before logging the turn, so a refused request leaves no history entry
+        model = self.model
+        active_model_name = model.model_name
 
-        final_prompt_parts = list(prompt_parts) # Work with a copy
-        if hasattr(self, 'root'): self.root.update_idletasks()
-        if self.translate_to_chinese_var.get():
-            translation_instruction = " Please provide your entire response in Chinese."
-        else:
-            translation_instruction = " Please provide your entire response in English."
+        # The language instruction goes last so the leading datasheet block stays a shared (cacheable) prefix
+        datasheet_parts = self._build_datasheet_context_parts()
+        request_parts = [*prompt_parts, self._translation_instruction()]
 
-        appended_to_text = False
-        for i in range(len(final_prompt_parts) - 1, -1, -1):
-            if isinstance(final_prompt_parts[i], str):
-                final_prompt_parts[i] += translation_instruction
-                appended_to_text = True; break
-        if not appended_to_text: final_prompt_parts.append(translation_instruction)
+        self.send_button.config(state=tk.DISABLED); self.user_input_entry.config(state=tk.DISABLED)
+        if self.start_comparison_button is not None: self.start_comparison_button.config(state=tk.DISABLED)
+        self.update_conversation_history(f"System: Sending to AI ({active_model_name})... May take time.", role="system")
 
-        try:
-            self.send_button.config(state=tk.DISABLED); self.user_input_entry.config(state=tk.DISABLED)
-            if hasattr(self, 'start_comparison_button'): self.start_comparison_button.config(state=tk.DISABLED)
-            self.update_conversation_history(f"System: Sending to AI ({active_model_name})... May take time.", role="system")
+        if is_initial_analysis and user_prompt_for_history:
+             self._add_to_ai_history('user', user_prompt_for_history)
 
-            if is_initial_analysis and user_prompt_for_history:
-                 self._add_to_ai_history('user', user_prompt_for_history)
+        self._start_background_task(
+            lambda: self._generate_with_datasheets(model, datasheet_parts, request_parts),
+            lambda response, error: self._on_ai_response(response, error, active_model_name, is_initial_analysis, on_response))
+        return True
+
+    def _generate_with_datasheets(self, model, datasheet_parts, request_parts):
+        """
+        Background half of send_to_ai. An identical earlier request (same model, datasheets, prompt and images) is answered
+        from the persistent response cache (returned as the plain text); otherwise the request is sent and a successful
+        answer is stored.
+        """
+        cache_key = _prompt_cache_key(model.model_name, [*datasheet_parts, *request_parts])
+        cached_text = self._response_cache.get(cache_key)
+        if cached_text is not None:
+            self.update_conversation_history("System: Identical request answered before; reusing the stored AI response.", role="system")
+            return cached_text
+        response = self._send_with_datasheets(model, datasheet_parts, request_parts)
+        try: response_text = response.text if response.candidates and not (response.prompt_feedback and response.prompt_feedback.block_reason) else ""
+        except ValueError: response_text = "" # No text part (e.g. stopped for safety); nothing to store
+        if response_text: self._response_cache.put(cache_key, response_text)
+        return response
+
+    def _send_with_datasheets(self, model, datasheet_parts, request_parts):
+        """
+        Serves the datasheet block from a context cache when the model supports one,
+        so only request_parts are uploaded; otherwise the block is sent inline ahead of them.
+        The answer is streamed into the history preview as it arrives; the resolved response is returned.
+        """
+        from google.api_core import exceptions as google_exceptions  # Lazy, see _preload_genai (already loaded with the SDK here)
+        response = None
+        cached_model = self._get_datasheet_cached_model(model, datasheet_parts)
+        if cached_model is not None:
+            # With stream=True the first chunk is fetched inside generate_content, so a dead cache still fails here, before any preview
+            try: response = cached_model.generate_content(request_parts, stream=True, request_options={'timeout': 600})
+            except (google_exceptions.NotFound, google_exceptions.PermissionDenied) as e: # Cache deleted or expired server-side
+                logger.debug("Context cache unusable, sending datasheets inline: %s", e); self._discard_datasheet_cache(cached_model)
+        if response is None:
+            response = model.generate_content([*datasheet_parts, *request_parts], stream=True, request_options={'timeout': 600})
+        self._forward_stream_chunks(response, model.model_name)
+        return response
+
+    def _get_datasheet_cached_model(self, model, datasheet_parts):
+        """Returns a model bound to a context cache of datasheet_parts (created on first use), or None if caching is unavailable."""
+        key = (model.model_name, *datasheet_parts)
+        with self._datasheet_cache_lock: entry = self._datasheet_cache
+        if entry is not None and entry[0] == key and time.monotonic() < entry[3]:
+            return entry[2]
+        self._discard_datasheet_cache()
+        try:
+            import google.generativeai as genai  # Lazy, see _preload_genai; already configured by _initialize_model
+            cache = genai.caching.CachedContent.create(model=model.model_name, contents=datasheet_parts, ttl=self.DATASHEET_CACHE_TTL_SECONDS)
+            cached_model = genai.GenerativeModel.from_cached_content(cache)
+        except Exception as e: # Model without caching support, datasheets below the minimum cacheable size, ...
+            logger.debug("Context caching unavailable for %s: %s", model.model_name, e); cache = cached_model = None
+        # The handle is dropped a minute before the server-side TTL so a request never races the expiry
+        entry = (key, cache, cached_model, time.monotonic() + self.DATASHEET_CACHE_TTL_SECONDS - 60)
+        with self._datasheet_cache_lock:
+            # clear_all bumps the generation before discarding, so a stale task can't store its cache after the discard
+            is_current = self._worker_context.generation == self._background_generation
+            if is_current: replaced, self._datasheet_cache = self._datasheet_cache, entry
+        if not is_current: # Cleared while the cache was being created: nothing would ever delete it
+            if cache is not None: _delete_cached_content_in_background(cache)
+            return None
+        if replaced is not None and replaced[1] is not None: _delete_cached_content_in_background(replaced[1])
+        return cached_model
 
-            response = self.model.generate_content(final_prompt_parts, request_options={'timeout': 600})
+    def _discard_datasheet_cache(self, cached_model=None):
+        """
+        Forgets the datasheet context cache (when cached_model is given, only if it is still the cached one)
+        and deletes it server-side on a daemon thread.
+        """
+        with self._datasheet_cache_lock:
+            entry = self._datasheet_cache
+            if entry is None or (cached_model is not None and entry[2] is not cached_model): return
+            self._datasheet_cache = None
+        if entry[1] is not None: _delete_cached_content_in_background(entry[1])
+
+    def _on_ai_response(self, response, error, active_model_name, is_initial_analysis, on_response):
+        """Tk-thread half of send_to_ai: displays/parses the generate_content response (or error) in place of the streamed preview."""
+        self._remove_stream_preview()
+        raw_ai_response_text = ""
+        ai_call_ok = False # Set once the response carries actual text (not blocked, not empty)
+        try:
+            if error is not None: raise error
 
-            if response.prompt_feedback and response.prompt_feedback.block_reason:
+            if isinstance(response, str): # Answer reused from ResponseCache; only non-empty answers are stored
+                raw_ai_response_text = response; ai_call_ok = True
+            elif response.prompt_feedback and response.prompt_feedback.block_reason:
                 raw_ai_response_text = f"AI Error - Prompt was blocked. Reason: {response.prompt_feedback.block_reason}"
                 self.update_conversation_history(f"System: {raw_ai_response_text}", role="error")
             elif not response.candidates or not hasattr(response, 'text') or not response.text:
                 raw_ai_response_text = "AI response empty/no content."
                 self.update_conversation_history(f"System: AI ({active_model_name}): {raw_ai_response_text}", role="system")
             else:
-                raw_ai_response_text = response.text
-                self.update_conversation_history(f"AI ({active_model_name}): {raw_ai_response_text}", role="ai") # Display formatted
+                raw_ai_response_text = response.text; ai_call_ok = True
+            if ai_call_ok: self.update_conversation_history(f"AI ({active_model_name}): {raw_ai_response_text}", role="ai") # Display formatted
 
             self._add_to_ai_history('model', raw_ai_response_text) # Log model's raw response or error
 
@@ -1475,56 +2170,52 @@ class ComponentComparatorAI:
                 parsed_info = self._parse_initial_analysis_response(raw_ai_response_text)
 
                 self.update_conversation_history(f"System: Initial Analysis Parsed Data:", role="system")
-                self.update_conversation_history(f"  Component 1 Type: {parsed_info['component1_type']}", role="system")
-                self.update_conversation_history(f"  Component 2 Type: {parsed_info['component2_type']}", role="system")
-                self.update_conversation_history(f"  Functionally Similar: {parsed_info['functionally_similar']}", role="system")
+                self.update_conversation_history(f"  Component 1 Type: {parsed_info.component1_type}", role="system")
+                self.update_conversation_history(f"  Component 2 Type: {parsed_info.component2_type}", role="system")
+                self.update_conversation_history(f"  Functionally Similar: {parsed_info.functionally_similar}", role="system")
 
                 if hasattr(self, 'mfg_pn_var_1'):
-                    self.mfg_pn_var_1.set(parsed_info['mfg_pn1'] if parsed_info['mfg_pn1'] != "Not Found" else "")
+                    self.mfg_pn_var_1.set(parsed_info.mfg_pn1 if parsed_info.mfg_pn1 != "Not Found" else "")
                     self.update_conversation_history(f"  MFG P/N 1 set to: {self.mfg_pn_var_1.get() or 'Not Found'}", role="system")
                 if hasattr(self, 'mfg_pn_var_2'):
-                    self.mfg_pn_var_2.set(parsed_info['mfg_pn2'] if parsed_info['mfg_pn2'] != "Not Found" else "")
+                    self.mfg_pn_var_2.set(parsed_info.mfg_pn2 if parsed_info.mfg_pn2 != "Not Found" else "")
                     self.update_conversation_history(f"  MFG P/N 2 set to: {self.mfg_pn_var_2.get() or 'Not Found'}", role="system")
 
-                if hasattr(self, 'root'): self.root.update_idletasks()
-
-                # Force update Entry widgets UI
-                if hasattr(self, 'mfg_pn_entry_1'):
-                    self.mfg_pn_entry_1.delete(0, tk.END)
-                    self.mfg_pn_entry_1.insert(0, self.mfg_pn_var_1.get())
-
-                if hasattr(self, 'mfg_pn_entry_2'):
-                    self.mfg_pn_entry_2.delete(0, tk.END)
-                    self.mfg_pn_entry_2.insert(0, self.mfg_pn_var_2.get())
+                # The MFG P/N entries are bound to these variables (textvariable), so .set() already updated them
 
                 if hasattr(self, 'start_comparison_button'):
-                    if parsed_info["is_similar_flag"] and not ("AI Error" in raw_ai_response_text or "empty/no content" in raw_ai_response_text) :
+                    if parsed_info.is_similar_flag and ai_call_ok:
                         self.start_comparison_button.config(state=tk.NORMAL)
                         self.update_conversation_history("System: Components appear functionally similar. 'Start Detailed Comparison' enabled.", role="system")
                     else:
                         self.start_comparison_button.config(state=tk.DISABLED)
                         self.update_conversation_history("System: Components may not be functionally similar or analysis incomplete. Detailed comparison not enabled.", role="system")
-            return raw_ai_response_text
         except Exception as e:
             err_msg = f"System: Error with AI ({active_model_name}): {e}"
-            self.update_conversation_history(err_msg, role="error"); print(f"DEBUG: {err_msg}")
+            self.update_conversation_history(err_msg, role="error"); logger.debug("%s", err_msg)
             self._add_to_ai_history('model', f"Error: {e}")
             if hasattr(self, 'start_comparison_button'): self.start_comparison_button.config(state=tk.DISABLED)
-            if isinstance(e, (google_exceptions.PermissionDenied,google_exceptions.Unauthenticated)): self.api_key_configured=False
-            if isinstance(e, (google_exceptions.InvalidArgument, ValueError, BlockedPromptException, StopCandidateException, google_exceptions.NotFound, google_exceptions.PermissionDenied)):
+            auth_errors, model_reset_errors = _ai_error_types()
+            if isinstance(e, auth_errors): self.api_key_configured=False
+            if isinstance(e, model_reset_errors):
                 self.update_conversation_history(f"System: Resetting model ({active_model_name}) due to error.", role="system")
-                self.model = None; self.chat_session = None; self.ai_history = []
-            return f"AI Error: {e}"
+                self.model = None; self.chat_session = None; self.ai_history = []; self._gemini_history_cache = None
+            raw_ai_response_text = f"AI Error: {e}"
         finally: self._update_ui_for_ai_status()
+        if on_response: on_response(raw_ai_response_text)
 
 def main():
+    # Log level is configurable via COMPARE_LOG_LEVEL (e.g. DEBUG); defaults to WARNING
+    logging.basicConfig(level=os.getenv("COMPARE_LOG_LEVEL", "WARNING").upper(),
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    root = tk.Tk()
     try:
-        s = ttk.Style(); available_themes = s.theme_names()
+        # Bound to root: ttk.Style() without a master would create a second, hidden Tk interpreter for the theme
+        s = ttk.Style(root); available_themes = s.theme_names()
         if "clam" in available_themes: s.theme_use("clam")
         elif "aqua" in available_themes: s.theme_use("aqua")
         elif "vista" in available_themes: s.theme_use("vista")
     except Exception: pass
-    root = tk.Tk()
     app = ComponentComparatorAI(root)
     root.mainloop()
 